@@ -20,6 +20,19 @@ function getRequestHeaders() {
   };
 }
 
+// Listings and the subreddit directory come a page at a time; `after` is
+// the `next` cursor of the previous page
+function pageUrl(url, after) {
+  return after ? `${url}?after=${encodeURIComponent(after)}` : url;
+}
+
+function LoadMore(props) {
+  if (!props.next) {
+    return null;
+  }
+  return <Button variant="link" onClick={props.onClick}>Load more</Button>;
+}
+
 class CommentForm extends Component {
   constructor(props) {
     super(props);
@@ -204,9 +217,12 @@ class Comment extends Component {
       })
         .then(response => response.json())
         .then(data => {
-          this.setState({
-            comment: data.comment
-          });
+          this.setState((prevState) => ({
+            comment: {
+              ...prevState.comment,
+              ...data.comment
+            }
+          }));
         });
     });
     return makeVote;
@@ -524,18 +540,26 @@ class CommentsPage extends Component {
 class Subreddit extends Component {
   constructor(props) {
     super(props);
-    this.state = {posts: [], error: false};
+    this.state = {posts: [], next: null, error: false};
+    this.loadPosts = this.loadPosts.bind(this);
   }
 
   componentDidMount() {
-    fetch(`/r/${this.props.match.params.name}/`)
+    this.loadPosts();
+  }
+
+  loadPosts() {
+    fetch(pageUrl(`/r/${this.props.match.params.name}/`, this.state.next))
       .then(response => {
         if (response.status !== 200) {
           return this.setState({error: true});
         }
         return response.json();
       })
-      .then(data => this.setState({posts: data.posts}));
+      .then(data => data && this.setState({
+        posts: this.state.posts.concat(data.posts),
+        next: data.next
+      }));
   }
 
   render() {
@@ -574,6 +598,7 @@ class Subreddit extends Component {
         <div>
           {posts}
         </div>
+        <LoadMore next={this.state.next} onClick={this.loadPosts} />
       </div>
     );
   }
@@ -786,18 +811,27 @@ class Home extends Component {
     super(props);
     this.state = {
       posts: [],
+      next: null
     };
+    this.loadPosts = this.loadPosts.bind(this);
   }
 
   componentDidMount() {
-    fetch('/posts/')
+    this.loadPosts();
+  }
+
+  loadPosts() {
+    fetch(pageUrl('/posts/', this.state.next))
       .then(response => {
         if (response.status !== 200) {
           return console.warn('Uh oh');
         }
         return response.json();
       })
-      .then(data => this.setState({posts: data.posts}));
+      .then(data => data && this.setState({
+        posts: this.state.posts.concat(data.posts),
+        next: data.next
+      }));
   }
 
   render() {
@@ -816,6 +850,7 @@ class Home extends Component {
             />
           );
         })}
+        <LoadMore next={this.state.next} onClick={this.loadPosts} />
       </div>
     );
   }
@@ -928,16 +963,23 @@ class SubredditList extends Component {
   constructor(props) {
     super(props);
     this.state = {
-      subredditList: []
+      subredditList: [],
+      next: null
     };
+    this.loadSubreddits = this.loadSubreddits.bind(this);
   }
 
   componentDidMount() {
-    fetch('/subreddits/')
+    this.loadSubreddits();
+  }
+
+  loadSubreddits() {
+    fetch(pageUrl('/subreddits/', this.state.next))
       .then(response => response.json())
       .then(data => {
         this.setState({
-          subredditList: data
+          subredditList: this.state.subredditList.concat(data.subreddits),
+          next: data.next
         });
       });
   }
@@ -958,6 +1000,7 @@ class SubredditList extends Component {
             </li>
           ))}
         </ul>
+        <LoadMore next={this.state.next} onClick={this.loadSubreddits} />
       </div>
     );
   }
@@ -1,10 +1,15 @@
 import jwt
 
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.base import ModelState
+from django.utils.functional import SimpleLazyObject
 
 from rest_framework import authentication, exceptions
 
-from .models import User
+from .cache import shared_cache
+from .models import Comment, Post, Subreddit, User
+from .token_revocations import token_revocations
 
 class AllowOptions(object):
     """
@@ -17,6 +22,55 @@ class AllowOptions(object):
     user = True
     is_authenticated = True
 
+def saved_state():
+    state = ModelState()
+    state.db = DEFAULT_DB_ALIAS
+    state.adding = False
+    return state
+
+class TokenUser(SimpleLazyObject):
+    """
+    The user a token was issued to.  The claims the token carries are read
+    without a query; anything else loads the User row on first use.
+    """
+    def __init__(self, claims):
+        super(TokenUser, self).__init__(lambda: User.objects.get(pk=claims['id']))
+        self.__dict__['claims'] = claims
+
+    # Answered from the claims, so checks like isinstance() and assigning
+    # the user to a foreign key do not load it
+    __class__ = property(lambda self: User)
+    __bool__ = lambda self: True
+    _state = saved_state()
+    pk = id = property(lambda self: self.claims['id'])
+    username = property(lambda self: self.claims['username'])
+    is_active = property(lambda self: self.claims['is_active'])
+    is_staff = property(lambda self: self.claims['is_staff'])
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_username(self):
+        return self.username
+
+def token_claims(request):
+    """
+    The claims of a valid, unrevoked token in the request's Authorization
+    header, or None.  For code that runs before authentication, such as
+    middleware.
+    """
+    header = authentication.get_authorization_header(request).split()
+    if len(header) != 2 or header[0].decode('utf-8').lower() != JWTAuthentication.authentication_header_prefix.lower():
+        return None
+    try:
+        payload = jwt.decode(header[1], settings.SECRET_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    if 'ver' not in payload or not payload['is_active']:
+        return None
+    if token_revocations.is_revoked(payload['id'], payload['ver']):
+        return None
+    return payload
+
 class JWTAuthentication(authentication.BaseAuthentication):
     authentication_header_prefix = 'Token'
 
@@ -78,6 +132,21 @@ class JWTAuthentication(authentication.BaseAuthentication):
             msg = 'Invalid authentication. Could not decode token.'
             raise exceptions.AuthenticationFailed(msg)
 
+        if 'ver' not in payload:
+            # Issued before tokens carried their claims
+            return self._authenticate_user(payload, token)
+
+        if token_revocations.is_revoked(payload['id'], payload['ver']):
+            msg = 'This token has been revoked.'
+            raise exceptions.AuthenticationFailed(msg)
+
+        if not payload['is_active']:
+            msg = 'This user has been deactivated.'
+            raise exceptions.AuthenticationFailed(msg)
+
+        return (TokenUser(payload), token)
+
+    def _authenticate_user(self, payload, token):
         try:
             user = User.objects.get(pk=payload['id'])
         except User.DoesNotExist:
@@ -89,3 +158,45 @@ class JWTAuthentication(authentication.BaseAuthentication):
             raise exceptions.AuthenticationFailed(msg)
 
         return (user, token)
+
+def subreddit_moderators(subreddit_id):
+    """The ids of a subreddit's moderators."""
+    return shared_cache.get_or_set(
+        'moderators',
+        subreddit_id,
+        lambda: set(Subreddit.moderators.through.objects.filter(
+            subreddit_id=subreddit_id
+        ).values_list('user_id', flat=True)),
+        ttl=300
+    )
+
+class AuthorPermissionBackend(object):
+    """
+    Lets every active user change and delete posts and comments in general,
+    and a particular post or comment if they wrote it or moderate its
+    subreddit.  Decided from the object's `author_id`, so unlike per-object
+    permission rows it needs no query (besides the cached moderator list,
+    for anyone but the author).
+    """
+    perms = {
+        'redditapp.change_post': Post,
+        'redditapp.delete_post': Post,
+        'redditapp.change_comment': Comment,
+        'redditapp.delete_comment': Comment,
+    }
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def has_perm(self, user_obj, perm, obj=None):
+        model = self.perms.get(perm)
+        if model is None or not user_obj.is_active or user_obj.is_anonymous:
+            return False
+        if obj is None:
+            return True
+        if not isinstance(obj, model):
+            return False
+        if obj.author_id == user_obj.pk:
+            return True
+        subreddit_id = obj.subreddit_id if model is Post else obj.post.subreddit_id
+        return user_obj.pk in subreddit_moderators(subreddit_id)
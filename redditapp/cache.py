@@ -0,0 +1,260 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from redditclone import db_router, instrumentation
+
+def now_and_on_commit(invalidate):
+    """
+    Runs `invalidate` immediately and again once the current transaction
+    commits, so an entry rebuilt from data that was not yet committed does
+    not outlive it.  With sharding on, that is the transaction on the shard
+    being written to.
+    """
+    from .sharding import current
+    invalidate()
+    transaction.on_commit(invalidate, using=current())
+
+class LRUCache:
+    """
+    A thread safe mapping holding at most `maxsize` entries, evicting the
+    least recently used one when full.  Entries older than `ttl` seconds are
+    treated as missing.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Deletes every entry for which `predicate(key, value)` is true."""
+        with self._lock:
+            for key in [k for k, (v, _) in self._entries.items() if predicate(k, v)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class NamespaceStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.recomputes = 0
+        self.recompute_seconds = 0.0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses + self.stale
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_ratio': (self.hits + self.stale) / lookups if lookups else None,
+            'recomputes': self.recomputes,
+            'recompute_seconds': self.recompute_seconds,
+        }
+
+class TwoTierCache:
+    """
+    A per-process LRUCache (L1) in front of Django's cache framework (L2),
+    shared by every worker.
+
+    Values are stored with the time they stop being fresh and kept in L2 for
+    `stale_ttl` seconds longer.  When a value goes stale only one caller
+    recomputes it: other threads of the process wait for it (or get the
+    stale value), and other processes see the lock key in L2 and serve the
+    stale value or wait for the new one to appear.  Callers with nothing
+    to serve that wait longer than `LOCK_TIMEOUT` compute the value
+    themselves.
+
+    L1 entries live at most `TWO_TIER_CACHE['L1_TTL']` seconds, which bounds
+    how long a deletion made by another process can go unnoticed.  Values
+    are computed from the primary database, never a lagging replica.
+    """
+    def __init__(self, alias='default'):
+        options = settings.TWO_TIER_CACHE
+        self.alias = alias
+        self.lock_timeout = options['LOCK_TIMEOUT']
+        self.l1 = LRUCache(options['L1_SIZE'], options['L1_TTL'])
+        # Per key: the lock of the thread recomputing it and the number of
+        # threads holding or waiting for that lock
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(NamespaceStats)
+
+    @property
+    def l2(self):
+        return caches[self.alias]
+
+    def _record(self, namespace, field, seconds=None):
+        if field != 'recomputes':
+            instrumentation.record_cache(field != 'misses')
+        with self._stats_lock:
+            stats = self._stats[namespace]
+            setattr(stats, field, getattr(stats, field) + 1)
+            if seconds is not None:
+                stats.recompute_seconds += seconds
+
+    def _fresh(self, cache_key):
+        now = time.time()
+        stale = None
+        for tier in (self.l1, self.l2):
+            entry = tier.get(cache_key)
+            if entry is None:
+                continue
+            if entry[1] > now:
+                if tier is self.l2:
+                    self.l1.set(cache_key, entry)
+                return entry, None
+            stale = stale or entry
+        return None, stale
+
+    def get_or_set(self, namespace, key, compute, ttl, stale_ttl=60):
+        """
+        Returns the cached value of `key`, calling `compute()` to produce
+        it when it is missing or more than `ttl` seconds old.
+        """
+        cache_key = f'{namespace}:{key}'
+        entry, stale = self._fresh(cache_key)
+        if entry is not None:
+            self._record(namespace, 'hits')
+            return entry[0]
+
+        with self._key_lock(cache_key, self.lock_timeout if stale is None else 0) as locked:
+            if not locked and stale is not None:
+                self._record(namespace, 'stale')
+                return stale[0]
+            # Another thread may have recomputed it while this one waited
+            entry, stale = self._fresh(cache_key)
+            if entry is not None:
+                self._record(namespace, 'hits')
+                return entry[0]
+            if not locked:
+                # The thread recomputing it is taking too long
+                return self._recompute(namespace, key, compute, ttl, stale_ttl)
+            lock_key = f'lock:{cache_key}'
+            added = self.l2.add(lock_key, 1, self.lock_timeout)
+            if not added:
+                if stale is not None:
+                    self._record(namespace, 'stale')
+                    return stale[0]
+                entry = self._wait_for(cache_key)
+                if entry is not None:
+                    self._record(namespace, 'hits')
+                    return entry[0]
+            try:
+                return self._recompute(namespace, key, compute, ttl, stale_ttl)
+            finally:
+                # Not another process's lock, after waiting it out
+                if added:
+                    self.l2.delete(lock_key)
+
+    @contextmanager
+    def _key_lock(self, cache_key, timeout):
+        """
+        Takes the lock of `cache_key` among the threads of this process,
+        waiting at most `timeout` seconds; gives whether it was taken.
+        """
+        with self._locks_lock:
+            held = self._locks.setdefault(cache_key, [threading.Lock(), 0])
+            held[1] += 1
+        if timeout:
+            locked = held[0].acquire(timeout=timeout)
+        else:
+            locked = held[0].acquire(blocking=False)
+        try:
+            yield locked
+        finally:
+            if locked:
+                held[0].release()
+            with self._locks_lock:
+                held[1] -= 1
+                if not held[1]:
+                    del self._locks[cache_key]
+
+    def _recompute(self, namespace, key, compute, ttl, stale_ttl):
+        self._record(namespace, 'misses')
+        start = time.perf_counter()
+        with db_router.primary():
+            value = compute()
+        self._record(namespace, 'recomputes', time.perf_counter() - start)
+        self.set(namespace, key, value, ttl, stale_ttl)
+        return value
+
+    def _wait_for(self, cache_key):
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = self.l2.get(cache_key)
+            if entry is not None and entry[1] > time.time():
+                self.l1.set(cache_key, entry)
+                return entry
+        return None
+
+    def set(self, namespace, key, value, ttl, stale_ttl=60):
+        cache_key = f'{namespace}:{key}'
+        entry = (value, time.time() + ttl)
+        self.l2.set(cache_key, entry, ttl + stale_ttl)
+        self.l1.set(cache_key, entry)
+
+    def delete(self, namespace, key):
+        cache_key = f'{namespace}:{key}'
+        self.l1.delete(cache_key)
+        self.l2.delete(cache_key)
+
+    def version(self, namespace, key):
+        """A counter kept in L2, for building keys that `bump` invalidates."""
+        return self.l2.get(f'version:{namespace}:{key}', 0)
+
+    def bump(self, namespace, key):
+        version_key = f'version:{namespace}:{key}'
+        try:
+            return self.l2.incr(version_key)
+        except ValueError:
+            if self.l2.add(version_key, 1, None):
+                return 1
+            return self.l2.incr(version_key)
+
+    def stats(self):
+        with self._stats_lock:
+            return {namespace: stats.as_dict() for namespace, stats in self._stats.items()}
+
+shared_cache = TwoTierCache()
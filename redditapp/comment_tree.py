@@ -0,0 +1,30 @@
+from collections import defaultdict
+
+from . import sharding
+from .models import Comment
+
+def tree_order(comment):
+    return (-comment.votes, comment.created)
+
+def load_comment_tree(post):
+    """
+    Loads every comment of `post` in a single query and links them into a
+    tree in memory, so serializing the comments page does not issue a query
+    per comment.  Each comment's children (and the post's top level
+    comments) are ordered by `-votes, created`, the same as the
+    `comments` and `child_comments` properties.
+
+    Returns the top level comments.
+    """
+    comments = sharding.related(Comment.objects.filter(post_id=post.pk), 'author')
+    children = defaultdict(list)
+    for comment in comments:
+        comment.post = post
+        children[comment.parent_comment_id].append(comment)
+    for siblings in children.values():
+        siblings.sort(key=tree_order)
+    for siblings in children.values():
+        for comment in siblings:
+            comment._child_comments = children.get(comment.pk, [])
+    post._comments = children.get(None, [])
+    return post._comments
@@ -9,7 +9,8 @@ def core_exception_handler(exc, context):
     }
     exception_class = exc.__class__.__name__
 
-    if exception_class in handlers:
+    # Django's own ValidationError is not one DRF turns into a response
+    if exception_class in handlers and response is not None:
         return handlers[exception_class](exc, context, response)
     return response
 
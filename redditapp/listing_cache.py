@@ -0,0 +1,116 @@
+from bisect import bisect_left
+
+from django.conf import settings
+
+from redditclone import db_router, instrumentation
+
+from . import sharding
+from .cache import LRUCache, shared_cache
+from .pagination import encode_cursor
+
+def post_row(post):
+    """The viewer independent part of a post's entry in a listing."""
+    return {
+        'id': post.id,
+        'title': post.title,
+        'slug': post.slug,
+        'subreddit': post.subreddit.name,
+        'link': post.link,
+        'numComments': post.comment_count,
+        'score': post.votes
+    }
+
+class RankedList:
+    """
+    The sort column values and ids of the first `LISTING_CACHE['DEPTH']`
+    posts of a listing, kept in ascending order so a cursor can be found
+    by bisection.
+    """
+    def __init__(self, rows, complete):
+        rows = rows[::-1]
+        self.keys = [tuple(row) for row in rows]
+        self.ids = [row[-1] for row in rows]
+        self.complete = complete
+
+class ListingCache:
+    """
+    Caches the ranked post ids of the front page and subreddit listings for
+    each sort, and the listing row of each post, in bounded LRU caches.
+
+    Entries are kept under the version of their listings in the shared
+    cache, which every write that changes a listing bumps (see
+    `invalidate_listings`), in any process.  So a listing is never served
+    from before the version its ETag was made from; entries of older
+    versions are left to expire after `LISTING_CACHE['TTL']` seconds or be
+    evicted.  Both are filled from the primary database.
+    """
+    def __init__(self):
+        options = settings.LISTING_CACHE
+        self.depth = options['DEPTH']
+        self.lists = LRUCache(options['MAX_LISTS'], options['TTL'])
+        self.rows = LRUCache(options['MAX_ROWS'], options['TTL'])
+
+    def version(self, subreddit_id):
+        """The version of a subreddit's listings, or the front page's for None."""
+        scope = 'all' if subreddit_id is None else subreddit_id
+        return (scope, shared_cache.version('listings', scope))
+
+    def page(self, queryset, listing_key, ordering, limit, after=None):
+        """
+        Returns the rows of one page of `queryset` in `ordering` and the
+        cursor of the next page, or None if the page reaches past the cached
+        depth and has to be read from the database.  `listing_key` is
+        `(subreddit_id or None, sort)`, plus the shard's alias for the
+        per-shard lists the sharded front page is merged from.
+        """
+        version = self.version(listing_key[0])
+        page = self.keys(queryset, listing_key, ordering, limit, after, version)
+        if page is None:
+            return None
+        keys, next_cursor = page
+        return self.load_rows(queryset.model, [key[-1] for key in keys], version), next_cursor
+
+    def keys(self, queryset, listing_key, ordering, limit, after=None, version=None):
+        """As `page`, but the sort column values of the rows (ending with the id)."""
+        # Read before the database, so a write landing in between leaves
+        # the entry under a version that is already out of date
+        version = version or self.version(listing_key[0])
+        ranked = self.lists.get((version, listing_key))
+        instrumentation.record_cache(ranked is not None)
+        if ranked is None:
+            columns = [f.lstrip('-') for f in ordering]
+            with db_router.primary():
+                rows = list(queryset.order_by(*ordering).values_list(*columns)[:self.depth])
+            ranked = RankedList(rows, complete=len(rows) < self.depth)
+            self.lists.set((version, listing_key), ranked)
+        start = len(ranked.keys) if after is None else bisect_left(ranked.keys, tuple(after))
+        end = start - limit
+        if end < 0 and not ranked.complete:
+            return None
+        end = max(end, 0)
+        keys = ranked.keys[end:start][::-1]
+        next_cursor = None
+        if keys and (end > 0 or not ranked.complete):
+            next_cursor = encode_cursor(ranked.keys[end])
+        return keys, next_cursor
+
+    def load_rows(self, model, ids, version):
+        """The rows of posts `ids`, for listings at `version` (see `version`)."""
+        rows = {pk: self.rows.get((version, pk)) for pk in ids}
+        missing = [pk for pk, row in rows.items() if row is None]
+        if missing:
+            with db_router.primary():
+                posts = list(sharding.related(model.objects.filter(pk__in=missing), 'subreddit'))
+            for post in posts:
+                rows[post.pk] = post_row(post)
+                self.rows.set((version, post.pk), rows[post.pk])
+        return [rows[pk] for pk in ids if rows[pk] is not None]
+
+    def stats(self):
+        return {'lists': self.lists.stats(), 'rows': self.rows.stats()}
+
+    def clear(self):
+        self.lists.clear()
+        self.rows.clear()
+
+listing_cache = ListingCache()
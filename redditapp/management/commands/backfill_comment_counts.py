@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from redditapp import sharding
+from redditapp.models import Comment, Post
+from redditapp.utils import pk_batches
+
+class Command(BaseCommand):
+    help = 'Recomputes Post.comment_count from the comment table, in batches of posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        counts = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post')
+        count = Subquery(counts.annotate(n=Count('pk')).values('n'))
+        updated = 0
+        for alias in sharding.aliases():
+            with sharding.using(alias):
+                for first_pk, last_pk in pk_batches(Post.objects.all(), options['batch_size']):
+                    # A single UPDATE per batch, so comments created while the
+                    # command runs are either counted by the subquery or
+                    # applied after it.
+                    updated += Post.objects.filter(pk__range=(first_pk, last_pk)).update(
+                        comment_count=Coalesce(count, 0)
+                    )
+        self.stdout.write(f'Backfilled comment counts for {updated} posts.')
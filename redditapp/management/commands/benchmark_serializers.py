@@ -0,0 +1,87 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from redditapp import fast_serializers
+from redditapp.models import Comment, Post, Subreddit, User
+from redditapp.serializers import PostSerializer
+
+class Command(BaseCommand):
+    help = (
+        'Times serializing a comments page of --nodes comments with DRF and '
+        'with the precompiled serializers in fast_serializers.py, after '
+        'checking that both render the same JSON.  Needs no database: the '
+        'tree is built in memory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        post = self.build_tree(options['nodes'], random.Random(options['seed']))
+        # No vote counter shards to add up
+        context = {'shard_votes': {}}
+        drf = lambda: PostSerializer(post, context=dict(context, shared=True)).data
+        fast = lambda: fast_serializers.comments_page(post, context)
+
+        renderer = JSONRenderer()
+        if renderer.render(drf()) != renderer.render(fast()):
+            raise CommandError('The fast serializers render different JSON than DRF.')
+
+        drf_time = self.best_of(drf, options['repeat'])
+        fast_time = self.best_of(fast, options['repeat'])
+        self.stdout.write(f'{options["nodes"]} comments, best of {options["repeat"]}:')
+        self.stdout.write(f'  DRF   {drf_time * 1000:.1f} ms')
+        self.stdout.write(f'  fast  {fast_time * 1000:.1f} ms')
+        self.stdout.write(f'  {drf_time / fast_time:.1f}x faster')
+
+    def best_of(self, serialize, repeat):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            serialize()
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    def build_tree(self, nodes, rng):
+        now = timezone.now()
+        users = [User(id=i, username=f'user{i}') for i in range(1, 51)]
+        subreddit = Subreddit(id=1, name='benchmark', creator=users[0], created=now)
+        post = Post(
+            id=1,
+            title='Benchmark',
+            subreddit=subreddit,
+            author=users[0],
+            body='post body',
+            slug='benchmark',
+            created=now,
+            last_modified=now
+        )
+        post._comments = []
+        comments = []
+        for pk in range(1, nodes + 1):
+            created = now - timedelta(minutes=rng.randrange(100000))
+            comment = Comment(
+                id=pk,
+                post=post,
+                author=rng.choice(users),
+                body=f'comment {pk} ' * rng.randrange(1, 20),
+                created=created,
+                last_modified=created + timedelta(minutes=rng.randrange(2)),
+                is_deleted=rng.random() < 0.05,
+                votes=rng.randrange(-10, 100)
+            )
+            comment._child_comments = []
+            # Mostly replies, so the tree gets deep as well as wide
+            if comments and rng.random() < 0.8:
+                rng.choice(comments)._child_comments.append(comment)
+            else:
+                post._comments.append(comment)
+            comments.append(comment)
+        return post
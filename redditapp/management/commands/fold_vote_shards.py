@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from redditapp import sharding
+from redditapp.models import VoteCounterShard
+from redditapp.votes import fold_vote_shards
+
+class Command(BaseCommand):
+    help = 'Moves the counts held in vote counter shards into the votes column of their post or comment.'
+
+    def handle(self, *args, **options):
+        folded = 0
+        for alias in sharding.aliases():
+            with sharding.using(alias):
+                targets = VoteCounterShard.objects.exclude(votes=0).values_list('post_id', 'comment_id').distinct()
+                for post_id, comment_id in targets.iterator():
+                    fold_vote_shards(post_id=post_id, comment_id=comment_id)
+                    folded += 1
+        self.stdout.write(f'Folded vote shards of {folded} posts and comments.')
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from redditapp import sharding
+from redditapp.models import Comment, Post
+
+class Command(BaseCommand):
+    help = (
+        'Starts the post and comment ids of each shard at the beginning of its '
+        'range (see sharding.ID_RANGE).  Run after migrating a new shard.'
+    )
+
+    def handle(self, *args, **options):
+        for index, alias in enumerate(sharding.aliases()):
+            if index == 0:
+                continue
+            connection = connections[alias]
+            start = index * sharding.ID_RANGE
+            for model in (Post, Comment):
+                with sharding.using(alias):
+                    if model.objects.filter(pk__gte=start).exists():
+                        continue
+                self.start_ids(connection, model._meta.db_table, start)
+                self.stdout.write(f'{alias}: {model._meta.model_name} ids start at {start + 1}.')
+
+    def start_ids(self, connection, table, start):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+                if not cursor.rowcount:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            elif connection.vendor == 'mysql':
+                cursor.execute(f'ALTER TABLE {connection.ops.quote_name(table)} AUTO_INCREMENT = {start + 1}')
+            else:
+                raise CommandError(f'Cannot set the next id on {connection.vendor}.')
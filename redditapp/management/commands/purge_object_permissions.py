@@ -0,0 +1,24 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from guardian.models import UserObjectPermission
+
+from redditapp.utils import pk_batches
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the per-object permission rows once written for every post '
+        'and comment, in batches.  AuthorPermissionBackend has replaced them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        content_types = ContentType.objects.filter(app_label='redditapp', model__in=['post', 'comment'])
+        rows = UserObjectPermission.objects.filter(content_type__in=content_types)
+        deleted = 0
+        for first_pk, last_pk in pk_batches(rows, options['batch_size']):
+            # Each batch is its own short DELETE, so the table is never
+            # locked for long
+            deleted += rows.filter(pk__range=(first_pk, last_pk)).delete()[0]
+        self.stdout.write(f'Deleted {deleted} object permission rows.')
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from redditapp import sharding
+from redditapp.models import Comment, Post, Vote, VoteCounterShard
+from redditapp.utils import pk_batches
+from redditapp.vote_buffer import vote_buffer
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the votes counter of every post and comment from the vote '
+        'table, in batches, and reports any drift.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Overwrite drifted counters with the recomputed totals (not while VOTE_BUFFER is enabled).'
+        )
+
+    def handle(self, *args, **options):
+        if options['fix'] and vote_buffer.enabled:
+            # Deltas buffered by the web processes are already counted in the
+            # vote table; a flush after --fix would count them twice
+            raise CommandError('--fix cannot run while VOTE_BUFFER is enabled.')
+        drifted = 0
+        for alias in sharding.aliases():
+            with sharding.using(alias):
+                for model, field in ((Post, 'post_id'), (Comment, 'comment_id')):
+                    drifted += self.reconcile(model, field, options['batch_size'], options['fix'])
+        self.stdout.write(f'{drifted} counters drifted.')
+
+    def reconcile(self, model, field, batch_size, fix):
+        name = model._meta.model_name
+        drifted = 0
+        total = Vote.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(
+            total=Sum('value')
+        ).values('total')
+        shard_votes = VoteCounterShard.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(
+            total=Sum('votes')
+        ).values('total')
+        for first_pk, last_pk in pk_batches(model.objects.all(), batch_size):
+            # The counter, the votes in counter shards (part of the stored
+            # count) and the vote total, read by one statement so a vote
+            # landing meanwhile is in all of them or none
+            stored = model.objects.filter(pk__range=(first_pk, last_pk)).annotate(
+                shard_votes=Coalesce(Subquery(shard_votes), 0),
+                total=Coalesce(Subquery(total), 0)
+            ).values_list('pk', 'votes', 'shard_votes', 'total')
+            for pk, votes, shard_votes, total in stored.iterator():
+                if votes + shard_votes == total:
+                    continue
+                drifted += 1
+                self.stdout.write(f'{name} {pk}: stored {votes + shard_votes}, actual {total}')
+                # Only overwrite the counter if no vote landed since it was
+                # read; otherwise the next run will pick it up
+                fixed = fix and model.objects.filter(pk=pk, votes=votes).update(votes=total - shard_votes)
+                if fixed:
+                    if model is Post:
+                        Post.objects.update_hot(pk)
+                    self.stdout.write(f'{name} {pk}: fixed')
+        return drifted
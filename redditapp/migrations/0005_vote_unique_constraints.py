@@ -0,0 +1,38 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:04
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_votes(apps, schema_editor):
+    # Keep the first vote of each voter on a post or comment.  Counters that
+    # included the duplicates can be repaired with reconcile_vote_counts.
+    Vote = apps.get_model('redditapp', 'Vote')
+    for target in ('post', 'comment'):
+        duplicates = (
+            Vote.objects.filter(**{f'{target}__isnull': False})
+            .values('voter', target)
+            .annotate(n=Count('id'), first_id=Min('id'))
+            .filter(n__gt=1)
+        )
+        for d in duplicates:
+            Vote.objects.filter(voter=d['voter'], **{target: d[target]}).exclude(id=d['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0004_post_comment_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('voter', 'post'), name='unique_post_vote'),
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('voter', 'comment'), name='unique_comment_vote'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0005_vote_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subreddit',
+            name='vote_shards',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='VoteCounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('votes', models.IntegerField(default=0)),
+                ('comment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='redditapp.Comment')),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='redditapp.Post')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='votecountershard',
+            constraint=models.UniqueConstraint(fields=('post', 'shard'), name='unique_post_shard'),
+        ),
+        migrations.AddConstraint(
+            model_name='votecountershard',
+            constraint=models.UniqueConstraint(fields=('comment', 'shard'), name='unique_comment_shard'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:07
+
+from datetime import datetime
+from math import log10
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# A copy of redditapp.models.hot_score as it was when this migration was
+# written, so later changes to the models cannot break it
+HOT_EPOCH = datetime(2005, 12, 8, 7, 46, 43, tzinfo=timezone.utc)
+
+
+def hot_score(votes, created):
+    order = log10(max(abs(votes), 1))
+    sign = 1 if votes > 0 else -1 if votes < 0 else 0
+    seconds = (created - HOT_EPOCH).total_seconds()
+    return round(sign * order + seconds / 45000, 7)
+
+
+def backfill_hot(apps, schema_editor):
+    Post = apps.get_model('redditapp', 'Post')
+    batch = []
+    for post in Post.objects.only('votes', 'created').iterator(chunk_size=1000):
+        post.hot = hot_score(post.votes, post.created)
+        batch.append(post)
+        if len(batch) == 1000:
+            Post.objects.bulk_update(batch, ['hot'])
+            batch = []
+    Post.objects.bulk_update(batch, ['hot'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0006_vote_counter_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hot',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_hot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0007_post_hot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent_comment', '-votes', 'created'], name='comment_post_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent_comment', '-votes', 'created'], name='comment_children_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_deleted', 'hot', 'id'], name='post_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_deleted', 'created', 'id'], name='post_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_deleted', 'votes', 'id'], name='post_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', 'is_deleted', 'hot', 'id'], name='post_subreddit_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', 'is_deleted', 'created', 'id'], name='post_subreddit_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['subreddit', 'is_deleted', 'votes', 'id'], name='post_subreddit_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subreddit',
+            index=models.Index(fields=['is_deleted', 'name'], name='subreddit_directory_idx'),
+        ),
+    ]
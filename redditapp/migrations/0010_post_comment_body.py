@@ -0,0 +1,34 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0009_user_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='body',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='body',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,67 @@
+import re
+
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery
+
+WRAPPED = re.compile(r'^Text object \(([0-9]+)\)$')
+
+
+# A copy of redditapp.utils.pk_batches as it was when this was written, so
+# later changes to the app can't change what this migration does
+def pk_batches(queryset, batch_size=1000):
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(batch[:batch_size])
+        if not pks:
+            return
+        yield pks[0], pks[-1]
+        last_pk = pks[-1]
+
+
+def copy_text(apps, schema_editor):
+    # One UPDATE per range of primary keys, each committed on its own, so no
+    # row stays locked for longer than a batch takes.  Rows without a Text
+    # (link posts) were never edited, but 0010 gave them the time it ran as
+    # last_modified: put it back to when they were created
+    Text = apps.get_model('redditapp', 'Text')
+    for name in ('Post', 'Comment'):
+        model = apps.get_model('redditapp', name)
+        text = Text.objects.filter(pk=OuterRef('text_id'))
+        for first_pk, last_pk in pk_batches(model.objects.all()):
+            batch = model.objects.filter(pk__range=(first_pk, last_pk))
+            batch.filter(text__isnull=False).update(
+                body=Subquery(text.values('text')[:1]),
+                last_modified=Subquery(text.values('last_modified')[:1])
+            )
+            batch.filter(text__isnull=True).update(last_modified=F('created'))
+    unwrap_post_bodies(apps)
+
+
+def unwrap_post_bodies(apps):
+    # Posts used to be created with a Text row wrapping another one, so
+    # their text is the str() of the inner row: copy that row's text instead
+    Text = apps.get_model('redditapp', 'Text')
+    Post = apps.get_model('redditapp', 'Post')
+    wrapped = Post.objects.filter(body__regex=r'^Text object \([0-9]+\)$').only('pk', 'body')
+    for first_pk, last_pk in pk_batches(wrapped):
+        posts = list(wrapped.filter(pk__range=(first_pk, last_pk)))
+        inner_ids = {post.pk: int(WRAPPED.match(post.body).group(1)) for post in posts}
+        inner = Text.objects.in_bulk(list(inner_ids.values()))
+        for post in posts:
+            if inner_ids[post.pk] in inner:
+                post.body = inner[inner_ids[post.pk]].text
+        Post.objects.bulk_update(posts, ['body'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('redditapp', '0010_post_comment_body'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_text, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:26
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0011_copy_text_inline'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='comment',
+            name='text',
+        ),
+        migrations.RemoveField(
+            model_name='post',
+            name='text',
+        ),
+        migrations.DeleteModel(
+            name='Text',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redditapp', '0013_subreddit_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedUser',
+            fields=[
+                ('user_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
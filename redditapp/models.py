@@ -1,29 +1,28 @@
-from django.db import models, transaction
-from django.db.models import Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Sum
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.utils.text import slugify
 from django.utils import timezone
-from datetime import datetime, timedelta
+from datetime import datetime
+from math import log10
 import jwt
 from django.conf import settings
 from django.core.exceptions import FieldError
-from django.contrib.auth.models import Permission
-from guardian.shortcuts import assign_perm
+
+from redditclone.metrics import registry
+
+from .cache import now_and_on_commit, shared_cache
+from . import sharding
+from .shard_folder import shard_folder
+from .token_revocations import TOKEN_LIFETIME, token_revocations
+from .vote_buffer import vote_buffer
 
 class R:
     def __init__(self, user):
         self.user = user
 
-def get_perm(codename):
-    return Permission.objects.get(content_type__app_label='redditapp', codename=codename)
-
-def get_model_perms():
-    perms = []
-    for op in ['change', 'delete']:
-        for model_name in ['comment', 'post']:
-            perms.append(get_perm(f'{op}_{model_name}'))
-    return perms
-
 def pluralize(value, unit):
     if value == 1:
         return f'1 {unit} ago'
@@ -44,11 +43,20 @@ def time_ago(dt):
         return pluralize(t.days//30, 'month')
     return pluralize(t.days//365, 'year')
 
+# Reddit's epoch for hot scores; 45000 seconds (12.5 hours) of age is worth
+# as much as a tenfold difference in score
+HOT_EPOCH = datetime(2005, 12, 8, 7, 46, 43, tzinfo=timezone.utc)
+
+def hot_score(votes, created):
+    order = log10(max(abs(votes), 1))
+    sign = 1 if votes > 0 else -1 if votes < 0 else 0
+    seconds = (created - HOT_EPOCH).total_seconds()
+    return round(sign * order + seconds / 45000, 7)
+
 def edited(model):
-    # The text object is created first so if the comment/post is unedited
-    # the last_modified will be before the created
-    # Maybe created should be an attribute of the text model
-    td = (model.text.last_modified - model.created)
+    # last_modified defaults to when the object is built, so if the
+    # comment/post is unedited it will be before the created
+    td = (model.last_modified - model.created)
     return td.days > -1 and td.seconds > 60 * 5
 
 class UserManager(BaseUserManager):
@@ -57,9 +65,7 @@ class UserManager(BaseUserManager):
             raise TypeError('Users must have a username')
         user = self.model(username=username, email=email)
         user.set_password(password)
-        with transaction.atomic():
-            user.save()
-            user.user_permissions.add(*get_model_perms())
+        user.save()
         return user
 
     def create_superuser(self, username, password, email=None):
@@ -80,6 +86,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Carried in tokens; bumping it revokes every token issued before
+    token_version = models.PositiveIntegerField(default=0)
 
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = []
@@ -105,23 +113,71 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self._generate_jwt_token()
 
     def _generate_jwt_token(self):
-        dt = datetime.now() + timedelta(days=60)
+        dt = datetime.now() + TOKEN_LIFETIME
 
+        # Everything JWTAuthentication needs, so it does not have to load
+        # the user
         token = jwt.encode({
             'id': self.pk,
+            'username': self.username,
+            'is_active': self.is_active,
+            'is_staff': self.is_staff,
+            'ver': self.token_version,
             'exp': int(dt.strftime('%s'))
         }, settings.SECRET_KEY, algorithm='HS256')
 
         return token.decode('utf-8')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super(User, cls).from_db(db, field_names, values)
+        user._token_claims = user.token_claims()
+        return user
+
+    def token_claims(self):
+        return (self.username, self.is_active, self.is_staff, self.is_superuser)
+
+    def set_password(self, raw_password):
+        super(User, self).set_password(raw_password)
+        if self.pk is not None:
+            self._password_changed = True
+
     def save(self, *args, **kwargs):
         if self.email == '':
             self.email = None
+        revoke = self.pk is not None and (
+            getattr(self, '_password_changed', False) or
+            getattr(self, '_token_claims', self.token_claims()) != self.token_claims()
+        )
+        if revoke:
+            # Tokens carry these, so the old ones must stop working
+            self.token_version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = [*kwargs['update_fields'], 'token_version']
         super(User, self).save(*args, **kwargs)
+        self._password_changed = False
+        self._token_claims = self.token_claims()
+        if revoke:
+            token_revocations.revoke(self.pk, self.token_version)
+
+class RevokedUser(models.Model):
+    """
+    A deleted user.  Tokens are checked without loading the user, so
+    theirs are kept revoked (see TokenRevocations) until they expire, after
+    which the row is pruned.
+    """
+    user_id = models.IntegerField(primary_key=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+@receiver(post_delete, sender=User)
+def revoke_deleted_user_tokens(sender, instance, **kwargs):
+    RevokedUser.objects.get_or_create(user_id=instance.pk)
+    RevokedUser.objects.filter(deleted_at__lt=timezone.now() - TOKEN_LIFETIME).delete()
+    token_revocations.revoke(instance.pk, token_revocations.DELETED)
 
 class SubredditManager(models.Manager):
     def create(self, name, creator):
-        subreddit = self.model(name=name, creator=creator)
+        subreddit = self.model(name=name, creator=creator, shard=sharding.place(name))
         with transaction.atomic():
             subreddit.save()
             subreddit.moderators.add(creator)
@@ -135,35 +191,130 @@ class Subreddit(models.Model):
     creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='creator')
     created = models.DateTimeField(auto_now_add=True)
     is_deleted = models.BooleanField(default=False)
+    # Number of VoteCounterShard rows each post/comment's votes are spread
+    # over; 1 keeps them in the `votes` column
+    vote_shards = models.PositiveSmallIntegerField(default=1)
+    # Index in SHARDS['ALIASES'] of the database holding the subreddit's
+    # posts, comments and votes
+    shard = models.PositiveSmallIntegerField(default=0)
     objects = SubredditManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_deleted', 'name'], name='subreddit_directory_idx'),
+        ]
+
     def __str__(self):
         return '/r/' + self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_subreddit(self)
+
+def invalidate_subreddit(subreddit):
+    """Drops the cached id of a saved or deleted subreddit and the directory."""
+    name = subreddit.name
+    now_and_on_commit(lambda: shared_cache.delete('subreddit-ids', name))
+    now_and_on_commit(lambda: shared_cache.bump('subreddits', 'directory'))
+
+@receiver(post_delete, sender=Subreddit)
+def invalidate_deleted_subreddit(sender, instance, **kwargs):
+    invalidate_subreddit(instance)
+    subreddit_id = instance.pk
+    now_and_on_commit(lambda: shared_cache.delete('subreddit-shard', subreddit_id))
+    # Its posts are gone from the front page
+    invalidate_listings(subreddit_id)
+
 class DeletedUser(object):
     username = '[deleted]'
     def get_username(self):
         return self.username
 
-class Text(models.Model):
-    text = models.TextField(blank=True)
-    last_modified = models.DateTimeField(auto_now=True)
+class InlineText(object):
+    """
+    Stands in for the Text row posts and comments used to point to, now that
+    the body is stored on them: `obj.text.text` reads and writes `obj.body`
+    and `obj.text.save()` saves just the body.
+    """
+    def __init__(self, owner):
+        self.owner = owner
+
+    @property
+    def text(self):
+        return self.owner.body
+
+    @text.setter
+    def text(self, value):
+        self.owner.body = value
+        self.owner.last_modified = timezone.now()
+
+    @property
+    def last_modified(self):
+        return self.owner.last_modified
+
+    def save(self):
+        self.owner.save(update_fields=['body', 'last_modified'])
+
+def get_inline_text(self):
+    return InlineText(self)
+
+def set_inline_text(self, value):
+    # Accepts a string or anything with a `text`, as `text=` did
+    self.body = getattr(value, 'text', value)
+
+inline_text = property(get_inline_text, set_inline_text)
+
+class PostManager(models.Manager):
+    def add_votes(self, pk, delta):
+        with sharding.using(sharding.for_id(pk)), sharding.atomic():
+            self.filter(pk=pk).update(votes=F('votes') + delta)
+            self.update_hot(pk)
+
+    def update_hot(self, pk):
+        """
+        Recomputes a post's hot score from its stored votes.  Called after
+        every change to `votes`, inside the transaction that changed it, so
+        the row lock taken by that UPDATE keeps the two in step.
+        """
+        with sharding.using(sharding.for_id(pk)):
+            row = self.filter(pk=pk).values_list('votes', 'created', 'subreddit_id').first()
+            if row:
+                self.filter(pk=pk).update(hot=hot_score(*row[:2]))
+                invalidate_listings(row[2])
 
 class Post(models.Model):
+    # Ranges of ids are set aside per shard (see sharding.ID_RANGE)
+    id = models.BigAutoField(primary_key=True)
     title = models.CharField(max_length=300)
-    subreddit = models.ForeignKey(Subreddit, on_delete=models.CASCADE)
+    # This and the user foreign keys of posts, comments and votes have no
+    # constraint in the database: with sharding on, users and subreddits are
+    # on another database
+    subreddit = models.ForeignKey(Subreddit, on_delete=models.CASCADE, db_constraint=False)
     created = models.DateTimeField(auto_now_add=True)
     link = models.URLField(blank=True, max_length=2000)
-    text = models.OneToOneField(
-        Text,
-        on_delete=models.CASCADE,
-        null=True
-    )
-    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='post_author')
+    body = models.TextField(blank=True, default='')
+    last_modified = models.DateTimeField(default=timezone.now)
+    text = inline_text
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='post_author', db_constraint=False)
     is_deleted = models.BooleanField(default=False)
     voters = models.ManyToManyField(User, through='Vote', through_fields=('post', 'voter'), related_name='post_voters')
     votes = models.IntegerField(default=0)
     slug = models.SlugField(null=False)
+    comment_count = models.IntegerField(default=0)
+    hot = models.FloatField(default=0)
+    objects = PostManager()
+
+    class Meta:
+        # One index per listing sort, for the front page and per subreddit,
+        # matching LISTING_ORDERS in views.py
+        indexes = [
+            models.Index(fields=['is_deleted', 'hot', 'id'], name='post_hot_idx'),
+            models.Index(fields=['is_deleted', 'created', 'id'], name='post_new_idx'),
+            models.Index(fields=['is_deleted', 'votes', 'id'], name='post_top_idx'),
+            models.Index(fields=['subreddit', 'is_deleted', 'hot', 'id'], name='post_subreddit_hot_idx'),
+            models.Index(fields=['subreddit', 'is_deleted', 'created', 'id'], name='post_subreddit_new_idx'),
+            models.Index(fields=['subreddit', 'is_deleted', 'votes', 'id'], name='post_subreddit_top_idx'),
+        ]
 
     def get_author(self):
         if self.is_deleted:
@@ -176,11 +327,13 @@ class Post(models.Model):
 
     @property
     def comments(self):
+        if hasattr(self, '_comments'):
+            return self._comments
         return self.comment_set.filter(parent_comment=None).order_by('-votes', 'created')
 
     @property
     def numComments(self):
-        return self.comment_set.count()
+        return self.comment_count
 
     @property
     def created_time_ago(self):
@@ -190,32 +343,54 @@ class Post(models.Model):
     def edited_time_ago(self):
         return time_ago(self.last_modified)
 
-    @property
-    def edited(self):
-        return edited(self.text)
-
     def save(self, *args, **kwargs):
         self.slug = slugify(self.title)
         new_record = self.pk is None
-        with transaction.atomic():
-            super(Post, self).save(*args, **kwargs)
+        if new_record:
+            # The author's own vote, counted here rather than by an UPDATE
+            # after it is written
+            self.votes = 1
+        self.hot = hot_score(self.votes, self.created or timezone.now())
+        with sharding.using(sharding.for_subreddit(self.subreddit_id)), sharding.atomic():
+            super(Post, self).save(*args, **sharding.on_shard(kwargs))
             if new_record:
-                Vote.objects.create(voter=self.author, value=1, post=self)
-                assign_perm('redditapp.change_post', self.author, self)
-                assign_perm('redditapp.delete_post', self.author, self)
+                Vote.objects.bulk_create([
+                    Vote(voter_id=self.author_id, value=1, post_id=self.pk, is_post=True, is_comment=False)
+                ])
+                shared_cache.set('post-subreddit', self.pk, self.subreddit_id, ttl=86400)
+                registry.inc('redditapp_posts_total')
+            invalidate_listings(self.subreddit_id)
+            invalidate_comments_page(self.pk)
 
     def __str__(self):
         return '/r/' + self.subreddit.name + ' -- ' + self.title
 
+class CommentManager(models.Manager):
+    def add_votes(self, pk, delta):
+        with sharding.using(sharding.for_id(pk)):
+            self.filter(pk=pk).update(votes=F('votes') + delta)
+
 class Comment(models.Model):
+    id = models.BigAutoField(primary_key=True)
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
-    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comment_author')
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comment_author', db_constraint=False)
     parent_comment = models.ForeignKey('self', null=True, on_delete=models.CASCADE, blank=True)
     created = models.DateTimeField(auto_now_add=True)
-    text = models.OneToOneField(Text, on_delete=models.CASCADE)
+    body = models.TextField(blank=True, default='')
+    last_modified = models.DateTimeField(default=timezone.now)
+    text = inline_text
     is_deleted = models.BooleanField(default=False)
     voters = models.ManyToManyField(User, through='Vote', through_fields=('comment', 'voter'), related_name='comment_voters')
     votes = models.IntegerField(default=0)
+    objects = CommentManager()
+
+    class Meta:
+        # For the `comments` and `child_comments` properties when the tree
+        # has not been loaded
+        indexes = [
+            models.Index(fields=['post', 'parent_comment', '-votes', 'created'], name='comment_post_top_idx'),
+            models.Index(fields=['parent_comment', '-votes', 'created'], name='comment_children_idx'),
+        ]
 
     def get_author(self):
         if self.is_deleted:
@@ -224,6 +399,8 @@ class Comment(models.Model):
 
     @property
     def child_comments(self):
+        if hasattr(self, '_child_comments'):
+            return self._child_comments
         return self.comment_set.all().order_by('-votes', 'created')
 
     @property
@@ -232,7 +409,7 @@ class Comment(models.Model):
 
     @property
     def edited_time_ago(self):
-        return time_ago(self.text.last_modified)
+        return time_ago(self.last_modified)
 
     @property
     def edited(self):
@@ -240,17 +417,161 @@ class Comment(models.Model):
 
     def save(self, *args, **kwargs):
         new_record = self.pk is None
-        with transaction.atomic():
-            super(Comment, self).save(*args, **kwargs)
+        if new_record:
+            # The author's own vote, as for posts
+            self.votes = 1
+        with sharding.using(sharding.for_id(self.post_id)), sharding.atomic():
+            if new_record:
+                # Also checks the post exists, before the comment is written
+                if not Post.objects.filter(pk=self.post_id).update(comment_count=F('comment_count') + 1):
+                    raise Post.DoesNotExist('Post matching query does not exist.')
+            super(Comment, self).save(*args, **sharding.on_shard(kwargs))
             if new_record:
-                Vote.objects.create(voter=self.author, value=1, comment=self)
-                assign_perm('redditapp.change_comment', self.author, self)
-                assign_perm('redditapp.delete_comment', self.author, self)
+                Vote.objects.bulk_create([
+                    Vote(voter_id=self.author_id, value=1, comment_id=self.pk, is_post=False, is_comment=True)
+                ])
+                invalidate_listings(post_subreddit_id(self.post_id))
+                registry.inc('redditapp_comments_total')
+            invalidate_comments_page(self.post_id)
 
     def __str__(self):
-        if len(self.text.text) < 20:
-            return self.text.text
-        return self.text.text[:20] + '...'
+        if len(self.body) < 20:
+            return self.body
+        return self.body[:20] + '...'
+
+@receiver(m2m_changed, sender=Subreddit.moderators.through)
+def invalidate_moderators(sender, instance, action, reverse, pk_set, **kwargs):
+    # Drops the lists AuthorPermissionBackend checks
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        subreddit_ids = [instance.pk]
+    elif action == 'pre_clear':
+        subreddit_ids = list(instance.moderators.values_list('pk', flat=True))
+    else:
+        subreddit_ids = pk_set
+    for subreddit_id in subreddit_ids:
+        now_and_on_commit(lambda subreddit_id=subreddit_id: shared_cache.delete('moderators', subreddit_id))
+
+@receiver(post_delete, sender=Comment)
+def decrement_comment_count(sender, instance, **kwargs):
+    # post_delete is also sent for replies removed by cascade, which
+    # Comment.delete() would never see
+    with sharding.using(sharding.for_id(instance.post_id)):
+        Post.objects.filter(pk=instance.post_id).update(comment_count=F('comment_count') - 1)
+    subreddit_id = post_subreddit_id(instance.post_id)
+    if subreddit_id is not None:
+        invalidate_listings(subreddit_id)
+    invalidate_comments_page(instance.post_id)
+
+@receiver(pre_delete, sender=User)
+@receiver(pre_delete, sender=Subreddit)
+def delete_from_shards(sender, instance, using, **kwargs):
+    """
+    Deletes a user's or subreddit's posts, comments and votes on the shards
+    other than the one the deletion runs on.  Django only cascades within
+    that database, and the foreign keys have no constraint to catch it.
+    """
+    if not sharding.enabled():
+        return
+    if sender is User:
+        querysets = [
+            Post.objects.filter(author_id=instance.pk),
+            Comment.objects.filter(author_id=instance.pk),
+            Vote.objects.filter(voter_id=instance.pk),
+        ]
+    else:
+        querysets = [Post.objects.filter(subreddit_id=instance.pk)]
+    for alias in sharding.aliases():
+        if alias == using:
+            continue
+        # Querysets pick their database when they run
+        with sharding.using(alias):
+            for queryset in querysets:
+                queryset.delete()
+
+def vote_target(post_id=None, comment_id=None):
+    """
+    The number of counter shards of the subreddit a post or comment is in,
+    the id of the post and the id of the subreddit.
+    """
+    if sharding.enabled():
+        # The subreddit is on another database, so it cannot be joined
+        if comment_id:
+            target = Comment.objects.filter(pk=comment_id).values_list('post_id', 'post__subreddit_id').first()
+        else:
+            target = Post.objects.filter(pk=post_id).values_list('pk', 'subreddit_id').first()
+        if target is None:
+            return (1, post_id, None)
+        shards = Subreddit.objects.filter(pk=target[1]).values_list('vote_shards', flat=True).first()
+        return (shards or 1,) + target
+    if comment_id:
+        targets = Comment.objects.filter(pk=comment_id).values_list(
+            'post__subreddit__vote_shards', 'post_id', 'post__subreddit_id'
+        )
+    else:
+        targets = Post.objects.filter(pk=post_id).values_list('subreddit__vote_shards', 'pk', 'subreddit_id')
+    return targets.first() or (1, post_id, None)
+
+def post_subreddit_id(post_id):
+    """The id of the subreddit a post is in.  Posts never move, so it is cached."""
+    def load():
+        with sharding.using(sharding.for_id(post_id)):
+            return Post.objects.filter(pk=post_id).values_list('subreddit_id', flat=True).first()
+    return shared_cache.get_or_set('post-subreddit', post_id, load, ttl=86400)
+
+def invalidate_comments_page(post_id):
+    """
+    Something shown on a post's comments page changed.  Bumps the version
+    the page is cached under and its ETag is made from (see CommentsPage).
+    """
+    now_and_on_commit(lambda: shared_cache.bump('comments-page', post_id))
+
+def invalidate_listings(subreddit_id):
+    """
+    Bumps the versions of a subreddit's listings and of the front page,
+    which their ETags and the listing cache's entries are kept under.
+    """
+    def bump():
+        shared_cache.bump('listings', subreddit_id)
+        shared_cache.bump('listings', 'all')
+    now_and_on_commit(bump)
+
+def add_to_votes(delta, post_id=None, comment_id=None, voter_id=None, located=None):
+    """
+    Adds `delta` to a post or comment's `votes` counter with a single UPDATE
+    of that column, so concurrent votes never overwrite each other's changes.
+
+    In subreddits with more than one vote shard the delta goes to one of
+    the target's VoteCounterShard rows instead, picked by the voter, so
+    concurrent voters lock different rows; the shard folder moves it to the
+    counter once the vote is committed.  Otherwise, with the vote buffer
+    enabled, the delta is handed to it once the vote is committed.
+
+    `located` is what `vote_target` returns, for callers that already have it.
+    """
+    if not delta:
+        return
+    shards, page_post_id, subreddit_id = located or vote_target(post_id=post_id, comment_id=comment_id)
+    invalidate_comments_page(page_post_id)
+    if not comment_id and subreddit_id is not None:
+        # Listings show buffered votes before they reach the `votes` column
+        invalidate_listings(subreddit_id)
+    if shards > 1:
+        VoteCounterShard.objects.add(delta, hash(voter_id) % shards, post_id=post_id, comment_id=comment_id)
+        transaction.on_commit(
+            lambda: shard_folder.add(post_id=post_id, comment_id=comment_id),
+            using=sharding.current()
+        )
+    elif vote_buffer.enabled:
+        transaction.on_commit(
+            lambda: vote_buffer.add(delta, post_id=post_id, comment_id=comment_id),
+            using=sharding.current()
+        )
+    elif comment_id:
+        Comment.objects.add_votes(comment_id, delta)
+    else:
+        Post.objects.add_votes(post_id, delta)
 
 class VoteManager(models.Manager):
     def create(self, voter, value, post=None, comment=None):
@@ -266,7 +587,7 @@ class VoteManager(models.Manager):
         return vote
 
 class Vote(models.Model):
-    voter = models.ForeignKey(User, on_delete=models.CASCADE)
+    voter = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     value = models.IntegerField() # should be -1 or 1
     is_post = models.BooleanField()
     is_comment = models.BooleanField()
@@ -274,38 +595,97 @@ class Vote(models.Model):
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, null=True, blank=True)
     objects = VoteManager()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['voter', 'post'], name='unique_post_vote'),
+            models.UniqueConstraint(fields=['voter', 'comment'], name='unique_comment_vote'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super(Vote, self).__init__(*args, **kwargs)
+        # The value already added to the post/comment's `votes` counter
+        self._counted_value = self.value if self.pk else 0
+
     def validate(self):
         if self.value not in [-1, 1]:
             raise FieldError('value must be in [-1, 1]')
-        if self.post is None and self.comment is None:
+        if self.post_id is None and self.comment_id is None:
             raise FieldError('post and comment cannot both be null')
-        if self.post and self.comment:
+        if self.post_id and self.comment_id:
             raise FieldError('cannot submit vote for both post and comment')
-        if self.pk is None and self.post and self.voter in self.post.voters.all():
-            raise FieldError('voter has already voted on this post')
-        if self.pk is None and self.comment and self.voter in self.comment.voters.all():
-            raise FieldError('voter has already voted on this comment')
         return True
 
+    def update_target_votes(self, delta):
+        add_to_votes(delta, post_id=self.post_id, comment_id=self.comment_id, voter_id=self.voter_id)
+        # Keep an already loaded target in step with the database
+        target = 'comment' if self.comment_id else 'post'
+        if delta and getattr(Vote, target).is_cached(self):
+            getattr(self, target).votes += delta
+
     def save(self, *args, **kwargs):
         self.validate()
-        with transaction.atomic():
-            super(Vote, self).save(*args, **kwargs)
-            if self.comment:
-                value__sum = self.comment.vote_set.aggregate(Sum('value'))
-                self.comment.votes = value__sum['value__sum']
-                self.comment.save()
-            if self.post:
-                value__sum = self.post.vote_set.aggregate(Sum('value'))
-                self.post.votes = value__sum['value__sum']
-                self.post.save()
+        try:
+            with sharding.using(sharding.for_id(self.comment_id or self.post_id)), sharding.atomic():
+                super(Vote, self).save(*args, **kwargs)
+                self.update_target_votes(self.value - self._counted_value)
+        except IntegrityError:
+            target = 'comment' if self.comment_id else 'post'
+            raise FieldError(f'voter has already voted on this {target}')
+        self._counted_value = self.value
 
     def delete(self, *args, **kwargs):
-        with transaction.atomic():
-            if self.comment:
-                self.comment.votes -= self.value
-                self.comment.save()
-            if self.post:
-                self.post.votes -= self.value
-                self.post.save()
+        with sharding.using(sharding.for_id(self.comment_id or self.post_id)), sharding.atomic():
             super(Vote, self).delete(*args, **kwargs)
+            self.update_target_votes(-self._counted_value)
+        self._counted_value = 0
+
+class VoteCounterShardManager(models.Manager):
+    def add(self, delta, shard, post_id=None, comment_id=None):
+        target = {'comment_id': comment_id} if comment_id else {'post_id': post_id}
+        shards = self.filter(shard=shard, **target)
+        if shards.update(votes=F('votes') + delta):
+            return
+        try:
+            with sharding.atomic():
+                self.create(shard=shard, votes=delta, **target)
+        except IntegrityError:
+            # Another vote created the shard first
+            shards.update(votes=F('votes') + delta)
+
+    def totals_for_post(self, post):
+        """
+        Sums the shards of a post and all of its comments in one query,
+        returning `{('post', id): total}` and `{('comment', id): total}`
+        entries in one dict.
+        """
+        totals = {}
+        if post.subreddit.vote_shards <= 1:
+            return totals
+        comment_ids = Comment.objects.filter(post_id=post.pk).values('pk')
+        shards = self.filter(models.Q(post_id=post.pk) | models.Q(comment_id__in=comment_ids))
+        rows = shards.order_by().values_list('post_id', 'comment_id').annotate(Sum('votes'))
+        for post_id, comment_id, total in rows:
+            if post_id is not None:
+                totals[('post', post_id)] = total
+            else:
+                totals[('comment', comment_id)] = total
+        return totals
+
+class VoteCounterShard(models.Model):
+    """
+    Part of the vote count of a post or comment in a subreddit with
+    `vote_shards` > 1.  The true score is `votes` plus the sum of the
+    target's shards; the shard folder moves the shards into `votes`, which
+    listings read as a cached total, shortly after each vote.
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, null=True, blank=True)
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, null=True, blank=True)
+    shard = models.PositiveSmallIntegerField()
+    votes = models.IntegerField(default=0)
+    objects = VoteCounterShardManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'shard'], name='unique_post_shard'),
+            models.UniqueConstraint(fields=['comment', 'shard'], name='unique_comment_shard'),
+        ]
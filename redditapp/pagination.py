@@ -0,0 +1,103 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core import exceptions
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, model, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise ValidationError({'after': 'Invalid cursor.'})
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise ValidationError({'after': 'Invalid cursor.'})
+    fields = [model._meta.get_field(f.lstrip('-')) for f in ordering]
+    if any(value is None or isinstance(value, (list, dict)) for value in values):
+        raise ValidationError({'after': 'Invalid cursor.'})
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (exceptions.ValidationError, TypeError, ValueError):
+        raise ValidationError({'after': 'Invalid cursor.'})
+
+def keyset_filter(ordering, values):
+    """
+    Matches the rows that come after `values` in `ordering`.  For
+    `('-hot', '-id')` that is `hot <= h AND (hot < h OR (hot = h AND id < i))`;
+    the bound on the leading column lets the database seek straight to the
+    cursor in an index on the sort columns instead of scanning past every
+    earlier row.
+    """
+    after = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        after |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    first = ordering[0]
+    lookup = 'lte' if first.startswith('-') else 'gte'
+    return Q(**{f'{first.lstrip("-")}__{lookup}': values[0]}) & after
+
+def page_params(request, model, ordering, default_limit=DEFAULT_LIMIT, max_limit=MAX_LIMIT):
+    """
+    Reads the `limit` and `after` query parameters, returning the page size
+    and the sort column values to continue after (None for the first page).
+    A `default_limit` or `max_limit` of None means no limit.
+    """
+    limit = request.query_params.get('limit', default_limit)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError({'limit': 'limit must be a number.'})
+        if limit < 1:
+            raise ValidationError({'limit': 'limit must be positive.'})
+        if max_limit is not None:
+            limit = min(limit, max_limit)
+    after = request.query_params.get('after')
+    if after:
+        after = decode_cursor(after, model, ordering)
+    return limit, after or None
+
+def cursor_for(row, ordering):
+    return encode_cursor([getattr(row, f.lstrip('-')) for f in ordering])
+
+def paginate(queryset, ordering, limit, after=None):
+    """
+    Returns `limit` rows of `queryset` in `ordering`, which must end with a
+    unique column, starting after the sort column values `after`, and the
+    cursor of the next page (None on the last page).
+    """
+    if after is not None:
+        queryset = queryset.filter(keyset_filter(ordering, after))
+    rows = list(queryset.order_by(*ordering)[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, cursor_for(rows[-1], ordering)
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination for generic list views using `paginate`.  The view
+    sets `ordering` and the key its results are returned under.
+    """
+    def paginate_queryset(self, queryset, request, view=None):
+        self.results_key = view.results_key
+        limit, after = page_params(request, queryset.model, view.ordering)
+        rows, self.next_cursor = paginate(queryset, view.ordering, limit, after)
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({self.results_key: data, 'next': self.next_cursor})
@@ -1,7 +1,14 @@
 from django.contrib.auth import authenticate
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 
+from redditclone.instrumentation import serializing
+
 from .models import *
+from . import sharding
+from .comment_tree import load_comment_tree
+from .votes import VoteMap
+from .vote_buffer import vote_buffer
 
 class RegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(
@@ -78,6 +85,10 @@ class DynamicFieldsModelSerializer(serializers.ModelSerializer):
             for field_name in exclude_fields:
                 self.fields.pop(field_name)
 
+    def to_representation(self, instance):
+        with serializing():
+            return super(DynamicFieldsModelSerializer, self).to_representation(instance)
+
 class UserSerializer(DynamicFieldsModelSerializer):
     username = serializers.CharField(source='get_username')
     class Meta:
@@ -103,17 +114,63 @@ class SubredditSerializer(DynamicFieldsModelSerializer):
             'creator': creator
         }
 
-class TextSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Text
-        fields = ('text',)
+class TextSerializer(serializers.Serializer):
+    # The body is stored on the post or comment (see InlineText); kept nested
+    # so the API reads and writes `{'text': {'text': ...}}` as before
+    text = serializers.CharField(allow_blank=True)
 
-def voted(user, comment, value):
-    return user.is_authenticated and bool(user.vote_set.filter(comment=comment, value=value))
+def vote_map(context, post_id):
+    """
+    Returns the viewer's votes for the page being serialized.  The map is
+    loaded once and kept in the serializer context, which nested serializers
+    share with the root.
+    """
+    votes = context.get('votes')
+    if votes is None:
+        votes = context['votes'] = VoteMap.for_post(context['request'].user, post_id)
+    return votes
 
-def voted_post(user, post, value):
-    return user.is_authenticated and bool(user.vote_set.filter(post=post, value=value))
+def live_votes(context, instance):
+    """
+    The score of a post or comment: its `votes` column plus any counts still
+    held in vote counter shards or in the vote buffer.
+    """
+    shard_votes = context.get('shard_votes')
+    if shard_votes is None:
+        post = instance if isinstance(instance, Post) else instance.post
+        shard_votes = context['shard_votes'] = VoteCounterShard.objects.totals_for_post(post)
+    if isinstance(instance, Post):
+        key, pending = ('post', instance.pk), vote_buffer.pending(post_id=instance.pk)
+    else:
+        key, pending = ('comment', instance.pk), vote_buffer.pending(comment_id=instance.pk)
+    return instance.votes + shard_votes.get(key, 0) + pending
 
+def personalize_comments(comments, votes):
+    for comment in comments:
+        value = votes.comment(comment['id'])
+        yield dict(
+            comment,
+            created_time_ago=time_ago(parse_datetime(comment['created'])),
+            edited_time_ago=time_ago(parse_datetime(comment['last_modified'])),
+            upvoted=value == 1,
+            downvoted=value == -1,
+            child_comments=list(personalize_comments(comment['child_comments'], votes))
+        )
+
+def personalize_page(page, votes):
+    """
+    Adds the viewer's `votes` and the times relative to now to a comments
+    page serialized with `shared` set in the context.  The page itself is
+    left alone, since it is shared with other requests.
+    """
+    value = votes.post(page['id'])
+    with serializing():
+        return dict(
+            page,
+            upvoted=value == 1,
+            downvoted=value == -1,
+            comments=list(personalize_comments(page['comments'], votes))
+        )
 
 class RecursiveField(serializers.Serializer):
     def to_representation(self, instance):
@@ -126,6 +183,7 @@ class CommentSerializer(DynamicFieldsModelSerializer):
     downvoted = serializers.BooleanField(default=False)
     child_comments = RecursiveField(many=True)
     text = TextSerializer()
+    last_modified = serializers.DateTimeField(read_only=True)
     class Meta:
         model = Comment
         fields = (
@@ -133,6 +191,7 @@ class CommentSerializer(DynamicFieldsModelSerializer):
             'author',
             'text',
             'created',
+            'last_modified',
             'edited',
             'created_time_ago',
             'edited_time_ago',
@@ -145,21 +204,31 @@ class CommentSerializer(DynamicFieldsModelSerializer):
 
     def to_representation(self, instance):
         data = super(CommentSerializer, self).to_representation(instance)
-        user = self.context['request'].user
-        data.update({
-            'upvoted': voted(user, instance, 1),
-            'downvoted': voted(user, instance, -1)
-        })
+        data['votes'] = live_votes(self.context, instance)
+        if self.context.get('shared'):
+            # Left for personalize_page to fill in per request
+            data.update({'created_time_ago': None, 'edited_time_ago': None})
+            return data
+        value = vote_map(self.context, instance.post_id).comment(instance.pk)
+        data.update({'upvoted': value == 1, 'downvoted': value == -1})
         return data
 
     def update(self, instance, validated_data):
-        with transaction.atomic():
-            new_text = validated_data.get('text', {}).get('text')
-            if instance.text.text != new_text:
-                instance.text.text = new_text
-                instance.text.save()
-            validated_data.pop('text', '')
-            super(CommentSerializer, self).update(instance, validated_data)
+        # Saves only the edited columns: a full save would write the `votes`
+        # loaded with the comment back over votes cast since
+        columns = {field.name for field in Comment._meta.concrete_fields}
+        update_fields = []
+        new_text = validated_data.pop('text', {}).get('text')
+        if new_text is not None and instance.body != new_text:
+            instance.text.text = new_text
+            update_fields += ['body', 'last_modified']
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+            if attr in columns:
+                update_fields.append(attr)
+        if update_fields:
+            with sharding.atomic():
+                instance.save(update_fields=update_fields)
         return instance
 
 class PostSerializer(DynamicFieldsModelSerializer):
@@ -189,10 +258,12 @@ class PostSerializer(DynamicFieldsModelSerializer):
         )
 
     def to_representation(self, instance):
+        if not hasattr(instance, '_comments'):
+            load_comment_tree(instance)
         data = super(PostSerializer, self).to_representation(instance)
-        user = self.context['request'].user
-        data.update({
-            'upvoted': voted_post(user, instance, 1),
-            'downvoted': voted_post(user, instance, -1)
-        })
+        data['votes'] = live_votes(self.context, instance)
+        if self.context.get('shared'):
+            return data
+        value = vote_map(self.context, instance.pk).post(instance.pk)
+        data.update({'upvoted': value == 1, 'downvoted': value == -1})
         return data
@@ -0,0 +1,60 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+class ShardFolder:
+    """
+    Folds the VoteCounterShard rows of the posts and comments voted on in
+    this process into their `votes` column from a background thread, every
+    `VOTE_SHARDS['FOLD_INTERVAL_MS']`.  Listings only read the column, so a
+    post's score and hot rank lag its votes by at most that long, while
+    concurrent voters still write to different shard rows.
+
+    Targets are only known to the process that voted on them; the
+    fold_vote_shards command catches up on any left by a process that
+    exited before folding them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._targets = set()
+        self._thread = None
+
+    @property
+    def options(self):
+        return settings.VOTE_SHARDS
+
+    def add(self, post_id=None, comment_id=None):
+        with self._lock:
+            self._targets.add((post_id, comment_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='shard-folder', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        from .votes import fold_vote_shards
+        with self._lock:
+            targets = self._targets
+            self._targets = set()
+        for post_id, comment_id in targets:
+            try:
+                fold_vote_shards(post_id=post_id, comment_id=comment_id)
+            except Exception:
+                logger.exception('Could not fold vote shards of post %s comment %s', post_id, comment_id)
+                with self._lock:
+                    self._targets.add((post_id, comment_id))
+
+    def _run(self):
+        while True:
+            time.sleep(self.options['FOLD_INTERVAL_MS'] / 1000)
+            self.flush()
+            close_old_connections()
+
+shard_folder = ShardFolder()
+
+atexit.register(shard_folder.flush)
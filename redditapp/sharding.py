@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from zlib import crc32
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .cache import shared_cache
+
+# Posts and comments on the shard at index i of `SHARDS['ALIASES']` get ids
+# from i * ID_RANGE, so an id alone tells which shard holds the row (see the
+# init_shards command)
+ID_RANGE = 2 ** 40
+
+# Models kept on their subreddit's shard; users and subreddits stay on the
+# primary, 'default'
+SHARDED_MODELS = {'post', 'comment', 'vote', 'votecountershard'}
+
+_shard = ContextVar('shard', default=None)
+
+def aliases():
+    return settings.SHARDS['ALIASES']
+
+def enabled():
+    return len(aliases()) > 1
+
+def place(name):
+    """The index of the shard a new subreddit called `name` goes on."""
+    return crc32(name.encode()) % len(aliases())
+
+def for_subreddit(subreddit_id):
+    """The alias of the shard holding a subreddit's posts, or None if sharding is off."""
+    if not enabled():
+        return None
+    Subreddit = apps.get_model('redditapp', 'Subreddit')
+    index = shared_cache.get_or_set(
+        'subreddit-shard',
+        subreddit_id,
+        lambda: Subreddit.objects.filter(pk=subreddit_id).values_list('shard', flat=True).first(),
+        ttl=86400
+    )
+    return aliases()[index or 0]
+
+def for_id(pk):
+    """The alias of the shard holding the post or comment `pk`, or None if sharding is off."""
+    if not enabled():
+        return None
+    index = int(pk) // ID_RANGE
+    return aliases()[index] if index < len(aliases()) else aliases()[0]
+
+def by_shard(pks):
+    """Groups post or comment ids by the alias of their shard, keeping their order."""
+    groups = OrderedDict()
+    for pk in pks:
+        groups.setdefault(for_id(pk), []).append(pk)
+    return groups.items()
+
+@contextmanager
+def using(alias):
+    """Queries of sharded models in the block go to `alias` (None changes nothing)."""
+    if alias is None:
+        yield
+        return
+    token = _shard.set(alias)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+def current():
+    """The alias sharded models are written to."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return _shard.get() or aliases()[0]
+
+def on_shard(save_kwargs):
+    """
+    The keyword arguments of a sharded model's `save`, writing to the
+    current shard: `Model.objects.create()` passes the database its
+    manager picked, before the model chose its shard.
+    """
+    if enabled():
+        save_kwargs['using'] = current()
+    return save_kwargs
+
+def atomic():
+    """`transaction.atomic` on the shard being written to."""
+    return transaction.atomic(using=current())
+
+def related(queryset, *fields):
+    """
+    `select_related(*fields)`, except with sharding on, where users and
+    subreddits are on another database than posts and comments and have to
+    be fetched with a query of their own.
+    """
+    if enabled():
+        return queryset.prefetch_related(*fields)
+    return queryset.select_related(*fields)
+
+class ShardRouter:
+    """
+    Sends queries of posts, comments and votes to the shard set with
+    `using`, or to the shard of the instance they follow a relation from.
+    Everything else, and everything when sharding is off, is left to the
+    next router.
+    """
+    def _db(self, model, **hints):
+        if not enabled() or model._meta.model_name not in SHARDED_MODELS:
+            return None
+        instance = hints.get('instance')
+        if _shard.get() is None and instance is not None and instance._state.db in aliases():
+            return instance._state.db
+        return current()
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
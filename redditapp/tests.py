@@ -1,31 +1,66 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
 from .models import *
 from .serializers import *
+from redditclone import db_router
+from redditclone.profiling import slow_queries
+
+from .backends import TokenUser
+from .cache import TwoTierCache, shared_cache
+from .token_revocations import TOKEN_LIFETIME, token_revocations
+from .listing_cache import ListingCache, listing_cache
+from .pagination import encode_cursor
+from .shard_folder import shard_folder
+from .vote_buffer import vote_buffer
+from .votes import cast_vote
+from . import fast_serializers, sharding
 
 def create_user(username='user', password='password'):
     user = User.objects.create_superuser(username, password)
     return user
 
-def create_post(title='Test post please ignore'):
-    author = create_user()
+def create_post(title='Test post please ignore', author=None):
+    author = author or create_user()
     sub = Subreddit.objects.create('TestSubreddit', author)
     post = Post.objects.create(
         title=title,
         subreddit=sub,
-        is_link=False,
-        author='user'
+        body='',
+        author=author
     )
     return author, post
 
-def create_comment(text='comment'):
-    author, post = create_post()
+def create_comment(text='comment', author=None, post=None, parent_comment=None):
+    if post is None:
+        author, post = create_post(author=author)
     comment = Comment.objects.create(
         post=post,
-        author=author,
-        text=text
+        author=author or post.author,
+        parent_comment=parent_comment,
+        body=text
     )
-    return author, post, comment
+    return comment.author, post, comment
+
+def clear_caches():
+    listing_cache.clear()
+    shared_cache.l1.clear()
+    caches['default'].clear()
 
 class EditCommentViewTests(TestCase):
     def test_user_must_have_jwt_token_to_edit(self):
@@ -38,7 +73,6 @@ class EditCommentViewTests(TestCase):
         post = Post.objects.create(
             title='Test post please ignore',
             subreddit=sub,
-            is_link=False,
             author=user
         )
         original_text = 'comment'
@@ -51,24 +85,24 @@ class EditCommentViewTests(TestCase):
         response = self.client.patch(
             reverse('redditapp:edit_comment', args=[comment.pk]),
             {
-                'text': edited_text
+                'text': {'text': edited_text}
             },
             content_type='application/json'
         )
         self.assertEqual(response.status_code, 403)
         comment.refresh_from_db()
-        self.assertEqual(comment.text, original_text)
+        self.assertEqual(comment.text.text, original_text)
         response = self.client.patch(
             reverse('redditapp:edit_comment', args=[comment.pk]),
             {
-                'text': edited_text
+                'text': {'text': edited_text}
             },
             content_type='application/json',
             HTTP_AUTHORIZATION=f'Token {user.token}'
         )
         self.assertEqual(response.status_code, 200)
         comment.refresh_from_db()
-        self.assertEqual(comment.text, edited_text)
+        self.assertEqual(comment.text.text, edited_text)
 
     def test_user_can_only_edit_own_comments(self):
         """
@@ -81,7 +115,6 @@ class EditCommentViewTests(TestCase):
         test_post = Post.objects.create(
             title='Test post please ignore',
             subreddit=test_sub,
-            is_link=False,
             author=user1
         )
         original_text = 'user2 should not be able to edit this comment'
@@ -94,11 +127,1203 @@ class EditCommentViewTests(TestCase):
         response = self.client.patch(
             reverse('redditapp:edit_comment', args=[user1_comment.pk]),
             {
-                'text': 'user2 has edited this comment'
+                'text': {'text': 'user2 has edited this comment'}
             },
             content_type='application/json',
             HTTP_AUTHORIZATION=f'Token {user2.token}'
         )
         self.assertEqual(response.status_code, 403)
         user1_comment.refresh_from_db()
-        self.assertEqual(user1_comment.text, original_text)
+        self.assertEqual(user1_comment.text.text, original_text)
+
+class CommentsPageTests(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_comment_tree_is_nested_and_ordered(self):
+        """
+        Comments are returned as a tree with each level ordered by votes and
+        then by creation time.
+        """
+        author, post, first = create_comment('first')
+        _, _, second = create_comment('second', post=post)
+        _, _, reply = create_comment('reply', post=post, parent_comment=first)
+        Comment.objects.filter(pk=second.pk).update(votes=5)
+
+        response = self.client.get(reverse('redditapp:comments_page', args=[post.pk]))
+        self.assertEqual(response.status_code, 200)
+        comments = response.json()['comments']
+        self.assertEqual([c['id'] for c in comments], [second.pk, first.pk])
+        self.assertEqual([c['id'] for c in comments[1]['child_comments']], [reply.pk])
+        self.assertEqual(comments[1]['child_comments'][0]['text'], {'text': 'reply'})
+
+    def test_query_count_does_not_grow_with_comments(self):
+        """
+        The whole comment tree is loaded in one query, so a large thread costs
+        the same number of queries as a small one.
+        """
+        author, post, parent = create_comment()
+        for i in range(20):
+            _, _, parent = create_comment(f'reply {i}', post=post, parent_comment=parent)
+            create_comment(f'sibling {i}', post=post)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('redditapp:comments_page', args=[post.pk]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_viewer_vote_state_is_loaded_in_one_query(self):
+        """
+        A logged in viewer sees their own votes on the post and every comment,
+        loaded with a single query for the whole page.
+        """
+        author, post, upvoted = create_comment('upvoted')
+        _, _, downvoted = create_comment('downvoted', post=post)
+        viewer = create_user('viewer')
+        Vote.objects.create(viewer, 1, comment=upvoted)
+        Vote.objects.create(viewer, -1, comment=downvoted)
+        for i in range(10):
+            create_comment(f'reply {i}', post=post, parent_comment=upvoted)
+
+        # The token carries the user, so only the post, comments and votes
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('redditapp:comments_page', args=[post.pk]),
+                HTTP_AUTHORIZATION=f'Token {viewer.token}'
+            )
+        data = response.json()
+        self.assertFalse(data['upvoted'])
+        comments = {c['id']: c for c in data['comments']}
+        self.assertTrue(comments[upvoted.pk]['upvoted'])
+        self.assertFalse(comments[upvoted.pk]['downvoted'])
+        self.assertTrue(comments[downvoted.pk]['downvoted'])
+        self.assertFalse(any(c['upvoted'] for c in comments[upvoted.pk]['child_comments']))
+
+    def test_rendered_page_is_shared_between_viewers(self):
+        """
+        Once rendered, the page is only overlaid with each viewer's votes and
+        the relative times; comments and votes render a new version.
+        """
+        author, post, comment = create_comment()
+        url = reverse('redditapp:comments_page', args=[post.pk])
+        self.client.get(url)
+        viewer = create_user('viewer')
+        Vote.objects.create(viewer, 1, comment=comment)
+        self.client.get(url)
+
+        auth = {'HTTP_AUTHORIZATION': f'Token {viewer.token}'}
+        # Only the viewer's votes
+        with self.assertNumQueries(1):
+            data = self.client.get(url, **auth).json()
+        self.assertTrue(data['comments'][0]['upvoted'])
+        self.assertEqual(data['comments'][0]['votes'], 2)
+        self.assertEqual(data['comments'][0]['created_time_ago'], 'just now')
+        with self.assertNumQueries(0):
+            data = self.client.get(url).json()
+        self.assertFalse(data['comments'][0]['upvoted'])
+
+        create_comment('reply', post=post, parent_comment=comment)
+        data = self.client.get(url, **auth).json()
+        self.assertEqual(len(data['comments'][0]['child_comments']), 1)
+        self.assertTrue(data['comments'][0]['upvoted'])
+
+class ListingTests(TestCase):
+    def test_listing_includes_viewer_vote_state(self):
+        """
+        The front page and subreddit listings report which posts the viewer
+        has voted on.
+        """
+        author, post = create_post()
+        response = self.client.get(
+            reverse('redditapp:posts'),
+            HTTP_AUTHORIZATION=f'Token {author.token}'
+        )
+        self.assertTrue(response.json()['posts'][0]['upvoted'])
+        response = self.client.get(reverse('redditapp:subreddit', args=['TestSubreddit']))
+        self.assertFalse(response.json()['posts'][0]['upvoted'])
+
+class CommentCountTests(TestCase):
+    def test_comment_count_follows_creates_and_deletes(self):
+        """
+        Creating a comment increments the post's comment count and deleting
+        one, including replies removed by cascade, decrements it.
+        """
+        author, post, comment = create_comment()
+        create_comment('reply', post=post, parent_comment=comment)
+        post.refresh_from_db()
+        self.assertEqual(post.comment_count, 2)
+        comment.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comment_count, 0)
+
+    def test_backfill_command_recounts(self):
+        author, post, comment = create_comment()
+        create_comment('second', post=post)
+        Post.objects.update(comment_count=0)
+        call_command('backfill_comment_counts', batch_size=1, stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual(post.comment_count, 2)
+
+class VoteCountTests(TestCase):
+    def test_votes_update_counter_incrementally(self):
+        """
+        Casting, changing and removing a vote adjust the target's counter by
+        the difference rather than recomputing it.
+        """
+        author, post, comment = create_comment()
+        voter = create_user('voter')
+        vote = Vote.objects.create(voter, -1, comment=comment)
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 0)
+        vote.value = 1
+        vote.save()
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 2)
+        Vote.objects.get(pk=vote.pk).delete()
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 1)
+
+    def test_reconcile_command_reports_and_fixes_drift(self):
+        author, post, comment = create_comment()
+        Comment.objects.filter(pk=comment.pk).update(votes=7)
+        out = StringIO()
+        call_command('reconcile_vote_counts', batch_size=1, fix=True, stdout=out)
+        self.assertIn(f'comment {comment.pk}: stored 7, actual 1', out.getvalue())
+        self.assertIn('1 counters drifted.', out.getvalue())
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 1)
+        post.refresh_from_db()
+        self.assertEqual(post.votes, 1)
+
+    def test_reconcile_counts_shards_and_refuses_to_fix_while_buffering(self):
+        author, post = create_post()
+        Subreddit.objects.filter(pk=post.subreddit_id).update(vote_shards=4)
+        for i in range(3):
+            cast_vote(create_user(f'voter{i}').pk, 1, post_id=post.pk)
+        out = StringIO()
+        call_command('reconcile_vote_counts', stdout=out)
+        self.assertIn('0 counters drifted.', out.getvalue())
+        with override_settings(VOTE_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL_MS': 60000, 'MAX_EVENTS': 10000}):
+            with self.assertRaises(CommandError):
+                call_command('reconcile_vote_counts', fix=True, stdout=StringIO())
+
+class VoteOnCommentTests(TestCase):
+    def vote(self, user, comment, value):
+        return self.client.post(
+            reverse('redditapp:vote_comment'),
+            {'vote': {'comment_id': comment.pk, 'value': value}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {user.token}'
+        )
+
+    def test_vote_returns_new_score(self):
+        """
+        Voting, changing a vote and removing it return the comment's new
+        score and leave at most one vote per voter.
+        """
+        author, post, comment = create_comment()
+        voter = create_user('voter')
+        for value, score in ((1, 2), (1, 2), (-1, 0), (0, 1), (0, 1)):
+            response = self.vote(voter, comment, value)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json()['comment'], {
+                'id': comment.pk,
+                'votes': score,
+                'upvoted': value == 1,
+                'downvoted': value == -1
+            })
+            self.assertLessEqual(Vote.objects.filter(voter=voter, comment=comment).count(), 1)
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 1)
+
+    def test_vote_on_missing_comment(self):
+        author, post, comment = create_comment()
+        response = self.vote(author, Comment(pk=comment.pk + 100), 1)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Vote.objects.filter(comment_id=comment.pk + 100).exists())
+
+    def test_vote_value_is_validated(self):
+        author, post, comment = create_comment()
+        response = self.vote(create_user('voter'), comment, 2)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('value', response.json()['errors'])
+
+    def test_duplicate_votes_are_rejected(self):
+        author, post, comment = create_comment()
+        with self.assertRaises(FieldError):
+            Vote.objects.create(author, 1, comment=comment)
+
+@override_settings(VOTE_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL_MS': 60000, 'MAX_EVENTS': 10000})
+class VoteBufferTests(TransactionTestCase):
+    def tearDown(self):
+        vote_buffer.flush()
+
+    def test_counter_changes_are_buffered_and_overlaid_on_reads(self):
+        """
+        With the buffer enabled votes are recorded immediately but counters
+        only change on flush; reads include the pending changes meanwhile.
+        """
+        author, post, comment = create_comment()
+        voter = create_user('voter')
+        response = self.client.post(
+            reverse('redditapp:vote_comment'),
+            {'vote': {'comment_id': comment.pk, 'value': 1}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {voter.token}'
+        )
+        self.assertEqual(response.json()['comment']['votes'], 2)
+        comment.refresh_from_db()
+        # Only the author's own vote, counted when the comment was written
+        self.assertEqual(comment.votes, 1)
+
+        response = self.client.get(reverse('redditapp:comments_page', args=[post.pk]))
+        self.assertEqual(response.json()['votes'], 1)
+        self.assertEqual(response.json()['comments'][0]['votes'], 2)
+
+        vote_buffer.flush()
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 2)
+        self.assertEqual(vote_buffer.pending(comment_id=comment.pk), 0)
+
+class VoteCounterShardTests(TestCase):
+    def test_sharded_votes_are_summed_on_read_and_folded(self):
+        """
+        In a subreddit with several vote shards, votes go to shard rows that
+        reads add to the votes column until they are folded into it.
+        """
+        author, post = create_post()
+        Subreddit.objects.filter(pk=post.subreddit_id).update(vote_shards=4)
+        _, _, comment = create_comment(post=post)
+        for i in range(6):
+            cast_vote(create_user(f'voter{i}').pk, 1, comment_id=comment.pk)
+        self.assertEqual(cast_vote(create_user('downvoter').pk, -1, comment_id=comment.pk), 6)
+        comment.refresh_from_db()
+        # Only the author's own vote, counted when the comment was written
+        self.assertEqual(comment.votes, 1)
+        self.assertGreater(VoteCounterShard.objects.filter(comment=comment).count(), 1)
+
+        response = self.client.get(reverse('redditapp:comments_page', args=[post.pk]))
+        self.assertEqual(response.json()['comments'][0]['votes'], 6)
+
+        call_command('fold_vote_shards', stdout=StringIO())
+        comment.refresh_from_db()
+        self.assertEqual(comment.votes, 6)
+        self.assertFalse(VoteCounterShard.objects.exclude(votes=0).exists())
+
+    def test_listing_sort_modes(self):
+        """
+        Listings can be sorted by hot score, creation time or score; hot
+        favours newer posts with the same score.
+        """
+        author, old = create_post('old')
+        new = Post.objects.create(
+            title='new',
+            subreddit=old.subreddit,
+            body='',
+            author=author
+        )
+        voter = create_user('voter')
+        cast_vote(voter.pk, 1, post_id=old.pk)
+        Post.objects.filter(pk=old.pk).update(created=old.created - timedelta(days=1))
+        Post.objects.update_hot(old.pk)
+
+        def ids(sort):
+            response = self.client.get(reverse('redditapp:posts'), {'sort': sort})
+            return [p['id'] for p in response.json()['posts']]
+
+        self.assertEqual(ids('hot'), [new.pk, old.pk])
+        self.assertEqual(ids('new'), [new.pk, old.pk])
+        self.assertEqual(ids('top'), [old.pk, new.pk])
+        response = self.client.get(reverse('redditapp:posts'), {'sort': 'best'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_hot_score_follows_votes(self):
+        author, post = create_post()
+        post.refresh_from_db()
+        self.assertEqual(post.hot, hot_score(1, post.created))
+        cast_vote(create_user('voter').pk, -1, post_id=post.pk)
+        post.refresh_from_db()
+        self.assertEqual(post.hot, hot_score(0, post.created))
+
+@override_settings(VOTE_SHARDS={'FOLD_INTERVAL_MS': 60000})
+class ShardFolderTests(TransactionTestCase):
+    def test_listing_follows_sharded_votes(self):
+        """
+        Votes on a post in a subreddit with several vote shards reach its
+        score and hot rank in listings once the shard folder runs.
+        """
+        clear_caches()
+        author, post = create_post('voted')
+        newer = Post.objects.create(title='newer', subreddit=post.subreddit, body='', author=author)
+        Subreddit.objects.filter(pk=post.subreddit_id).update(vote_shards=4)
+        for i in range(5):
+            cast_vote(create_user(f'voter{i}').pk, 1, post_id=post.pk)
+
+        def listing():
+            response = self.client.get(reverse('redditapp:posts'), {'sort': 'hot'})
+            return [(p['id'], p['score']) for p in response.json()['posts']]
+
+        self.assertEqual(listing(), [(newer.pk, 1), (post.pk, 1)])
+        shard_folder.flush()
+        self.assertEqual(listing(), [(post.pk, 6), (newer.pk, 1)])
+        post.refresh_from_db()
+        self.assertEqual(post.hot, hot_score(6, post.created))
+        self.assertFalse(VoteCounterShard.objects.exclude(votes=0).exists())
+
+class PaginationTests(TestCase):
+    def test_listing_pages_follow_cursor(self):
+        """
+        Listings are returned `limit` posts at a time with a cursor to the
+        next page, and the pages cover every post exactly once.
+        """
+        author, post = create_post('post 0')
+        for i in range(1, 7):
+            Post.objects.create(
+                title=f'post {i}',
+                subreddit=post.subreddit,
+                body='',
+                author=author
+            )
+        for sort in ('hot', 'new', 'top'):
+            seen = []
+            params = {'sort': sort, 'limit': 4}
+            while True:
+                data = self.client.get(reverse('redditapp:subreddit', args=['TestSubreddit']), params).json()
+                self.assertLessEqual(len(data['posts']), 4)
+                seen += [p['title'] for p in data['posts']]
+                if data['next'] is None:
+                    break
+                params['after'] = data['next']
+            self.assertEqual(sorted(seen), [f'post {i}' for i in range(7)])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('redditapp:posts'), {'after': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_cursor_values_are_rejected(self):
+        for values in (['abc', 1], [{'a': 1}, 1], [None, 1], [1.5, 'abc']):
+            for sort in ('hot', 'new', 'top'):
+                response = self.client.get(
+                    reverse('redditapp:posts'),
+                    {'sort': sort, 'after': encode_cursor(values)}
+                )
+                self.assertEqual(response.status_code, 400, (sort, values))
+
+    def test_subreddit_directory_is_paginated(self):
+        user = create_user()
+        for name in ('c', 'a', 'b'):
+            Subreddit.objects.create(name, user)
+        data = self.client.get(reverse('redditapp:subreddit_list'), {'limit': 2}).json()
+        self.assertEqual([s['name'] for s in data['subreddits']], ['a', 'b'])
+        data = self.client.get(reverse('redditapp:subreddit_list'), {'limit': 2, 'after': data['next']}).json()
+        self.assertEqual([s['name'] for s in data['subreddits']], ['c'])
+        self.assertIsNone(data['next'])
+
+@skipUnless(connection.vendor in ('sqlite', 'mysql'), 'EXPLAIN output is only parsed for SQLite and MySQL')
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on every query issued by the hot read endpoints and fails
+    if one falls back to a full table scan or sorts rows itself instead of
+    reading them in index order.
+    """
+    def setUp(self):
+        self.author, self.post, comment = create_comment()
+        create_comment('reply', post=self.post, parent_comment=comment)
+        Subreddit.objects.filter(pk=self.post.subreddit_id).update(vote_shards=4)
+        Subreddit.objects.create('AnotherSubreddit', self.author)
+        for i in range(3):
+            Post.objects.create(
+                title=f'post {i}',
+                subreddit=self.post.subreddit,
+                body='',
+                author=self.author
+            )
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute('EXPLAIN ' + sql)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def bad_steps(self, plan):
+        if connection.vendor == 'sqlite':
+            return [step for step in plan if step.startswith('SCAN') or 'B-TREE FOR ORDER BY' in step]
+        return [row for row in plan if row['type'] == 'ALL' or 'filesort' in (row['Extra'] or '')]
+
+    def assertIndexedPlans(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params, HTTP_AUTHORIZATION=f'Token {self.author.token}')
+        self.assertEqual(response.status_code, 200)
+        for query in queries.captured_queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            plan = self.explain(query['sql'])
+            self.assertEqual(self.bad_steps(plan), [], f'{url}: {query["sql"]}\n{plan}')
+        return response.json()
+
+    def test_listings(self):
+        for sort in ('hot', 'new', 'top'):
+            for url in (reverse('redditapp:posts'), reverse('redditapp:subreddit', args=['TestSubreddit'])):
+                data = self.assertIndexedPlans(url, {'sort': sort, 'limit': 2})
+                self.assertIndexedPlans(url, {'sort': sort, 'limit': 2, 'after': data['next']})
+
+    def test_comments_page(self):
+        self.assertIndexedPlans(reverse('redditapp:comments_page', args=[self.post.pk]))
+
+    def test_subreddit_directory(self):
+        data = self.assertIndexedPlans(reverse('redditapp:subreddit_list'), {'limit': 1})
+        self.assertIndexedPlans(reverse('redditapp:subreddit_list'), {'limit': 1, 'after': data['next']})
+
+class ListingCacheTests(TestCase):
+    def setUp(self):
+        listing_cache.clear()
+        self.author, self.post = create_post()
+
+    def get_posts(self, **params):
+        return self.client.get(reverse('redditapp:posts'), params).json()['posts']
+
+    def test_repeated_listing_is_served_from_cache(self):
+        self.get_posts()
+        hits = listing_cache.stats()['lists']['hits']
+        with self.assertNumQueries(0):
+            self.get_posts()
+        self.assertEqual(listing_cache.stats()['lists']['hits'], hits + 1)
+
+    def test_writes_invalidate_cached_listing(self):
+        """
+        Votes, new comments and new posts show up in a cached listing
+        straight away.
+        """
+        self.get_posts(sort='top')
+        other = Post.objects.create(
+            title='other',
+            subreddit=self.post.subreddit,
+            body='',
+            author=self.author
+        )
+        self.assertEqual([p['id'] for p in self.get_posts(sort='top')], [other.pk, self.post.pk])
+
+        cast_vote(create_user('voter').pk, 1, post_id=self.post.pk)
+        create_comment(post=self.post)
+        posts = self.get_posts(sort='top')
+        self.assertEqual([p['id'] for p in posts], [self.post.pk, other.pk])
+        self.assertEqual(posts[0]['score'], 2)
+        self.assertEqual(posts[0]['numComments'], 1)
+
+    @override_settings(LISTING_CACHE={'MAX_LISTS': 2, 'MAX_ROWS': 2, 'DEPTH': 2, 'TTL': 30})
+    def test_pages_past_cached_depth_fall_back_to_database(self):
+        cache = ListingCache()
+        for i in range(2):
+            Post.objects.create(
+                title=f'post {i}',
+                subreddit=self.post.subreddit,
+                body='',
+                author=self.author
+            )
+        queryset = Post.objects.all()
+        ordering = ('-votes', '-id')
+        rows, next_cursor = cache.page(queryset, (None, 'top'), ordering, 2)
+        self.assertEqual(len(rows), 2)
+        self.assertIsNotNone(next_cursor)
+        self.assertIsNone(cache.page(queryset, (None, 'top'), ordering, 3))
+        self.assertEqual(cache.rows.stats()['size'], 2)
+
+    def test_post_voted_into_cached_depth_shows_up(self):
+        """
+        A vote that lifts a post into a listing cached only to a depth it was
+        past drops the cached listing.
+        """
+        self.addCleanup(setattr, listing_cache, 'depth', listing_cache.depth)
+        listing_cache.depth = 2
+        clear_caches()
+        others = [
+            Post.objects.create(title=f'post {i}', subreddit=self.post.subreddit, body='', author=self.author)
+            for i in range(2)
+        ]
+        ids = lambda: [p['id'] for p in self.get_posts(sort='top', limit=2)]
+        self.assertEqual(ids(), [others[1].pk, others[0].pk])
+        cast_vote(create_user('voter').pk, 1, post_id=self.post.pk)
+        self.assertEqual(ids(), [self.post.pk, others[1].pk])
+
+class TwoTierCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = TwoTierCache()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_values_are_served_from_l1_then_l2(self):
+        self.assertEqual(self.cache.get_or_set('ns', 'key', self.compute, ttl=60), 1)
+        self.assertEqual(self.cache.get_or_set('ns', 'key', self.compute, ttl=60), 1)
+        # Another process has an empty L1 but shares L2
+        self.assertEqual(TwoTierCache().get_or_set('ns', 'key', self.compute, ttl=60), 1)
+        self.assertEqual(self.calls, 1)
+        stats = self.cache.stats()['ns']
+        self.assertEqual((stats['hits'], stats['misses'], stats['recomputes']), (1, 1, 1))
+
+    def test_stale_value_served_while_another_process_recomputes(self):
+        self.cache.get_or_set('ns', 'key', self.compute, ttl=-1)
+        caches['default'].add('lock:ns:key', 1)
+        self.assertEqual(self.cache.get_or_set('ns', 'key', self.compute, ttl=60), 1)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['ns']['stale'], 1)
+
+    def test_concurrent_misses_compute_once(self):
+        def slow_compute():
+            time.sleep(0.1)
+            return self.compute()
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                self.cache.get_or_set('ns', 'key', slow_compute, ttl=60)
+            ))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(self.calls, 1)
+
+    def test_lock_timeout_without_stale_value(self):
+        """
+        A caller with no stale value that waits out a slow recompute computes
+        the value itself, and leaves another process's lock key alone.
+        """
+        self.cache.lock_timeout = 0.2
+        started = threading.Event()
+        def slow_compute():
+            started.set()
+            time.sleep(0.6)
+            return 'slow'
+        thread = threading.Thread(target=lambda: self.cache.get_or_set('ns', 'key', slow_compute, ttl=60))
+        thread.start()
+        started.wait()
+        self.assertEqual(self.cache.get_or_set('ns', 'key', lambda: 'own', ttl=60), 'own')
+        # Other keys are not held up by it
+        self.assertEqual(self.cache.get_or_set('ns', 'other', self.compute, ttl=60), 1)
+        thread.join()
+
+        caches['default'].add('lock:ns:third', 1)
+        self.assertEqual(self.cache.get_or_set('ns', 'third', self.compute, ttl=60), 2)
+        self.assertIsNotNone(caches['default'].get('lock:ns:third'))
+        self.assertEqual(self.cache._locks, {})
+
+    def test_subreddit_lookups_and_directory_are_cached(self):
+        author, post = create_post()
+        url = reverse('redditapp:subreddit', args=[post.subreddit.name])
+        self.client.get(url)
+        # The name lookup and the listing itself are both cached
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.assertEqual(self.client.get(reverse('redditapp:subreddit', args=['nope'])).status_code, 404)
+
+        names = lambda: [s['name'] for s in self.client.get(reverse('redditapp:subreddit_list')).json()['subreddits']]
+        self.assertEqual(names(), ['TestSubreddit'])
+        with self.assertNumQueries(0):
+            names()
+        Subreddit.objects.create('another', author)
+        self.assertEqual(names(), ['TestSubreddit', 'another'])
+
+class ETagTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.author, self.post = create_post()
+
+    def assertRevalidates(self, url, change, **headers):
+        """
+        A request repeating the ETag gets a 304 without touching the database
+        until `change()` makes the response differ.
+        """
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 304)
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_listings(self):
+        voter = create_user('voter')
+        self.assertRevalidates(
+            reverse('redditapp:posts'),
+            lambda: cast_vote(voter.pk, 1, post_id=self.post.pk)
+        )
+        self.assertRevalidates(
+            reverse('redditapp:subreddit', args=[self.post.subreddit.name]),
+            lambda: create_comment(post=self.post)
+        )
+
+    def test_deleted_subreddit(self):
+        url = reverse('redditapp:subreddit_list')
+        etag = self.client.get(url)['ETag']
+        name = self.post.subreddit.name
+        self.assertEqual(self.client.get(reverse('redditapp:subreddit', args=[name])).status_code, 200)
+        self.post.subreddit.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()['subreddits']), (200, []))
+        self.assertEqual(self.client.get(reverse('redditapp:subreddit', args=[name])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('redditapp:posts')).json()['posts'], [])
+
+    def test_listing_changed_by_another_process(self):
+        """
+        A new ETag comes with the new content, even when the change was made
+        by a process whose writes this one's listing cache did not see.
+        """
+        url = reverse('redditapp:posts')
+        etag = self.client.get(url)['ETag']
+        Post.objects.filter(pk=self.post.pk).update(votes=10)
+        shared_cache.bump('listings', self.post.subreddit_id)
+        shared_cache.bump('listings', 'all')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['posts'][0]['score'], 10)
+
+    def test_comments_page(self):
+        _, _, comment = create_comment(post=self.post)
+        voter = create_user('voter')
+        self.assertRevalidates(
+            reverse('redditapp:comments_page', args=[self.post.pk]),
+            lambda: cast_vote(voter.pk, 1, comment_id=comment.pk),
+            HTTP_AUTHORIZATION=f'Token {voter.token}'
+        )
+
+    def test_directory(self):
+        self.assertRevalidates(
+            reverse('redditapp:subreddit_list'),
+            lambda: Subreddit.objects.create('another', self.author)
+        )
+
+    def test_etag_depends_on_viewer(self):
+        url = reverse('redditapp:comments_page', args=[self.post.pk])
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(
+            url,
+            HTTP_IF_NONE_MATCH=etag,
+            HTTP_AUTHORIZATION=f'Token {self.author.token}'
+        )
+        self.assertEqual(response.status_code, 200)
+
+class TokenAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.url = reverse('redditapp:user')
+
+    def tearDown(self):
+        token_revocations.clear()
+
+    def get(self, token):
+        return self.client.get(self.url, HTTP_AUTHORIZATION=f'Token {token}')
+
+    def test_token_claims_authenticate_without_queries(self):
+        clear_caches()
+        self.client.get(reverse('redditapp:posts'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('redditapp:posts'), HTTP_AUTHORIZATION=f'Token {self.user.token}')
+        user = TokenUser({'id': self.user.pk, 'username': 'user', 'is_active': True, 'is_staff': False, 'ver': 0})
+        with self.assertNumQueries(0):
+            self.assertTrue(isinstance(user, User) and user.is_authenticated)
+            self.assertEqual((user.pk, user.username), (self.user.pk, 'user'))
+        with self.assertNumQueries(1):
+            self.assertIsNone(user.email)
+
+    def test_password_change_and_deactivation_revoke_tokens(self):
+        token = self.user.token
+        self.assertEqual(self.get(token).status_code, 200)
+        self.user.set_password('new password')
+        self.user.save()
+        self.assertEqual(self.get(token).status_code, 403)
+        token = self.user.token
+        self.assertEqual(self.get(token).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(token).status_code, 403)
+
+    def test_update_responds_with_new_claims(self):
+        response = self.client.put(
+            self.url,
+            {'user': {'username': 'renamed'}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {self.user.token}'
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()['user']
+        self.assertEqual(data['username'], 'renamed')
+        self.assertEqual(self.get(data['token']).json()['user']['username'], 'renamed')
+
+    def test_deleted_user_tokens_are_revoked(self):
+        _, post = create_post(author=create_user('other'))
+        token = self.user.token
+        self.user.delete()
+        response = self.client.post(
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': post.pk, 'text': 'orphan'}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {token}'
+        )
+        self.assertEqual(response.status_code, 403)
+        # Another process learns of it from the database
+        token_revocations.clear()
+        with self.settings(TOKEN_REVOCATION_REFRESH=30):
+            self.assertEqual(self.get(token).status_code, 403)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_revocations_are_loaded_incrementally_and_expire(self):
+        expired = timezone.now() - TOKEN_LIFETIME - timedelta(days=1)
+        RevokedUser.objects.create(user_id=1000)
+        RevokedUser.objects.filter(user_id=1000).update(deleted_at=expired)
+        old = create_user('old')
+        User.objects.filter(pk=old.pk).update(token_version=1, updated_at=expired)
+        token_revocations.clear()
+        with self.settings(TOKEN_REVOCATION_REFRESH=0):
+            self.assertFalse(token_revocations.is_revoked(1000, 0))
+            self.assertFalse(token_revocations.is_revoked(old.pk, 0))
+
+            # Changes made by another process since the last load
+            RevokedUser.objects.create(user_id=1001)
+            User.objects.filter(pk=self.user.pk).update(token_version=1, updated_at=timezone.now())
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(token_revocations.is_revoked(1001, 0))
+            self.assertTrue(all('>=' in q['sql'] for q in queries))
+            self.assertTrue(token_revocations.is_revoked(self.user.pk, 0))
+
+        deleted = create_user('deleted')
+        deleted_pk = deleted.pk
+        deleted.delete()
+        # Deleting a user prunes the expired rows
+        self.assertEqual(set(RevokedUser.objects.values_list('user_id', flat=True)), {1001, deleted_pk})
+
+class AuthorPermissionTests(TestCase):
+    def test_authors_and_moderators_can_change_comments(self):
+        author = User.objects.create_user('author', 'password')
+        _, post, comment = create_comment(author=author)
+        moderator = User.objects.create_user('moderator', 'password')
+        other = User.objects.create_user('other', 'password')
+        post.subreddit.moderators.add(moderator)
+        comment = Comment.objects.get(pk=comment.pk)
+        self.assertTrue(author.has_perm('redditapp.change_comment', comment))
+        self.assertTrue(moderator.has_perm('redditapp.delete_comment', comment))
+        self.assertFalse(other.has_perm('redditapp.change_comment', comment))
+        self.assertFalse(other.has_perm('redditapp.change_post', post))
+        self.assertTrue(other.has_perm('redditapp.change_comment'))
+
+        post.subreddit.moderators.remove(moderator)
+        self.assertFalse(moderator.has_perm('redditapp.delete_comment', comment))
+
+    def test_no_object_permission_rows_are_written(self):
+        from guardian.models import UserObjectPermission
+        from guardian.shortcuts import assign_perm
+        author, post, comment = create_comment()
+        self.assertFalse(UserObjectPermission.objects.exists())
+
+        assign_perm('redditapp.change_post', author, post)
+        assign_perm('redditapp.change_comment', author, comment)
+        call_command('purge_object_permissions', batch_size=1, stdout=StringIO())
+        self.assertFalse(UserObjectPermission.objects.exists())
+
+class CreateQueryBudgetTests(TestCase):
+    """
+    Creating a post runs at most 2 statements and a comment at most 3, not
+    counting savepoints, once the subreddit's id is cached.
+    """
+    def setUp(self):
+        clear_caches()
+        self.author, self.post = create_post()
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.author.token}'}
+
+    def assertStatements(self, budget, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(*args, content_type='application/json', **kwargs, **self.auth)
+        statements = [q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertLessEqual(len(statements), budget, statements)
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_create_query_budget(self):
+        name = self.post.subreddit.name
+        self.client.get(reverse('redditapp:subreddit', args=[name]))
+        data = self.assertStatements(
+            2,
+            reverse('redditapp:create_post', args=[name]),
+            {'post': {'title': 'new post', 'text': 'body'}}
+        )
+        post = Post.objects.get(pk=data['id'])
+        self.assertEqual((post.text.text, post.votes), ('body', 1))
+
+        comment = self.assertStatements(
+            3,
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': post.pk, 'text': 'first'}}
+        )
+        self.assertEqual(comment['votes'], 1)
+        self.assertTrue(comment['upvoted'])
+        self.assertEqual(comment['author'], {'username': self.author.username})
+        reply = self.assertStatements(
+            3,
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': post.pk, 'parent_comment_id': comment['id'], 'text': 'reply'}}
+        )
+        post.refresh_from_db()
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(Comment.objects.get(pk=reply['id']).parent_comment_id, comment['id'])
+        self.assertEqual(Vote.objects.filter(comment_id=reply['id'], voter=self.author).count(), 1)
+
+    def test_comment_on_missing_post(self):
+        response = self.client.post(
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': self.post.pk + 100, 'text': 'lost'}},
+            content_type='application/json',
+            **self.auth
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Comment.objects.exists())
+
+@override_settings(INSTRUMENTATION={'SAMPLE_RATE': 1.0, 'QUERY_BUDGET': 1})
+class InstrumentationTests(TestCase):
+    def test_server_timing_and_query_budget(self):
+        clear_caches()
+        author, post, comment = create_comment()
+        url = reverse('redditapp:comments_page', args=[post.pk])
+        with self.assertLogs('redditclone.requests', 'WARNING') as logs:
+            response = self.client.get(url)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+        self.assertIn('ser;dur=', response['Server-Timing'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['queries'], line['over_query_budget']), ('redditapp:comments_page', 2, 1))
+
+        with self.assertLogs('redditclone.requests', 'INFO') as logs:
+            response = self.client.get(url)
+        self.assertIn('desc="0 queries"', response['Server-Timing'])
+        self.assertEqual(json.loads(logs.records[0].getMessage())['cache_misses'], 0)
+
+    @override_settings(INSTRUMENTATION={'SAMPLE_RATE': 0, 'QUERY_BUDGET': 1})
+    def test_unsampled_requests_are_not_measured(self):
+        self.assertFalse(self.client.get(reverse('redditapp:posts')).has_header('Server-Timing'))
+
+class MetricsTests(TestCase):
+    def scrape(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def metric(self, text, line):
+        for row in text.splitlines():
+            if row.startswith(line + ' '):
+                return float(row.rsplit(' ', 1)[1])
+        return 0
+
+    def test_requests_and_writes_are_counted(self):
+        before = self.scrape()
+        author, post, comment = create_comment()
+        self.client.get(reverse('redditapp:posts'))
+        cast_vote(create_user('voter').pk, 1, post_id=post.pk)
+        after = self.scrape()
+        for line in (
+            'redditapp_comments_total',
+            'redditapp_votes_total',
+            'http_request_duration_seconds_count{view="redditapp:posts"}',
+        ):
+            self.assertEqual(self.metric(after, line), self.metric(before, line) + 1, line)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', after)
+        self.assertIn('le="+Inf"', after)
+
+    def test_processes_are_merged_through_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other = {'counters': {'redditapp_votes_total|[]': 5}, 'histograms': {}}
+            with open(os.path.join(directory, '1.json'), 'w') as f:
+                json.dump(other, f)
+            own = self.metric(self.scrape(), 'redditapp_votes_total')
+            with override_settings(METRICS=dict(settings.METRICS, DIRECTORY=directory)):
+                self.assertEqual(self.metric(self.scrape(), 'redditapp_votes_total'), own + 5)
+
+    def test_scrapes_are_limited_to_allowed_ips(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        slow_queries.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings = override_settings(PROFILING=dict(settings.PROFILING, DIRECTORY=directory.name, SLOW_QUERY_MS=0))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.author, self.post = create_post()
+
+    def test_staff_can_profile_a_request(self):
+        staff = {'HTTP_AUTHORIZATION': f'Token {self.author.token}'}
+        url = reverse('redditapp:comments_page', args=[self.post.pk])
+        response = self.client.get(url, HTTP_X_PROFILE='1', **staff)
+        profile_id = response['X-Profile-Id']
+        response = self.client.get(reverse('profile', args=[profile_id]), {'summary': 1}, **staff)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'cumulative', response.content)
+
+        user = User.objects.create_user('not staff', 'password')
+        response = self.client.get(url, HTTP_X_PROFILE='1', HTTP_AUTHORIZATION=f'Token {user.token}')
+        self.assertFalse(response.has_header('X-Profile-Id'))
+        response = self.client.get(reverse('profile', args=[profile_id]), HTTP_AUTHORIZATION=f'Token {user.token}')
+        self.assertEqual(response.status_code, 403)
+
+    def test_slow_queries_are_grouped_by_call_site(self):
+        _, _, comment = create_comment(post=self.post)
+        slow_queries.clear()
+        for _ in range(2):
+            clear_caches()
+            self.client.get(reverse('redditapp:comments_page', args=[self.post.pk]))
+        sites = {entry['site']: entry for entry in slow_queries.report()}
+        tree = [site for site in sites if site.startswith('redditapp/comment_tree.py')]
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(sites[tree[0]]['count'], 2)
+        self.assertIn('load_comment_tree', tree[0])
+
+class InlineTextTests(TestCase):
+    """
+    The body is stored on the post or comment; the API still nests it as
+    `{'text': {'text': ...}}`.
+    """
+    def test_edit_comment_body(self):
+        author, post, comment = create_comment('first')
+        self.assertEqual((comment.body, comment.text.text), ('first', 'first'))
+        response = self.client.patch(
+            reverse('redditapp:edit_comment', args=[comment.pk]),
+            {'text': {'text': 'second'}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {author.token}'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['text'], {'text': 'second'})
+        previous = comment.last_modified
+        comment.refresh_from_db()
+        self.assertEqual(comment.body, 'second')
+        self.assertGreater(comment.last_modified, previous)
+
+    def test_edit_keeps_votes_cast_since_loading(self):
+        author, post, comment = create_comment('first')
+        comment = Comment.objects.get(pk=comment.pk)
+        cast_vote(create_user('voter').pk, 1, comment_id=comment.pk)
+        serializer = CommentSerializer(comment, data={'text': {'text': 'second'}}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        comment.refresh_from_db()
+        self.assertEqual((comment.body, comment.votes), ('second', 2))
+
+    def test_comments_page_text_shape(self):
+        author, post, comment = create_comment('reply')
+        post.text = 'post body'
+        post.save()
+        clear_caches()
+        data = self.client.get(reverse('redditapp:comments_page', args=[post.pk])).json()
+        self.assertEqual(data['text'], {'text': 'post body'})
+        self.assertEqual(data['comments'][0]['text'], {'text': 'reply'})
+        self.assertFalse(data['comments'][0]['edited'])
+
+@override_settings(REPLICAS={'ALIASES': ['replica'], 'PIN_SECONDS': 5})
+class ReplicaTests(TestCase):
+    """
+    The 'replica' database is left empty, standing in for a replica that has
+    not caught up with anything yet.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        clear_caches()
+        token_revocations.clear()
+
+    def test_routing(self):
+        self.assertEqual(db_router.ReplicaRouter().db_for_read(Post), 'default')
+        with db_router.replica():
+            self.assertEqual(db_router.ReplicaRouter().db_for_read(Post), 'replica')
+            self.assertEqual(db_router.ReplicaRouter().db_for_write(Post), 'default')
+            with db_router.primary():
+                self.assertEqual(db_router.ReplicaRouter().db_for_read(Post), 'default')
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        author, post = create_post()
+        viewer = User.objects.create_user('viewer', 'password')
+        auth = {'HTTP_AUTHORIZATION': f'Token {viewer.token}'}
+        cast_vote(viewer.pk, -1, post_id=post.pk)
+        # The listing is cached, so filled from the primary, but the viewer's
+        # votes are read from the replica
+        data = self.client.get(reverse('redditapp:posts'), **auth).json()
+        self.assertEqual([p['id'] for p in data['posts']], [post.pk])
+        self.assertFalse(data['posts'][0]['downvoted'])
+
+        response = self.client.post(
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': post.pk, 'text': 'first'}},
+            content_type='application/json',
+            **auth
+        )
+        self.assertEqual(response.status_code, 201)
+        data = self.client.get(reverse('redditapp:posts'), **auth).json()
+        self.assertTrue(data['posts'][0]['downvoted'])
+        # Other users still read from the replica
+        data = self.client.get(reverse('redditapp:posts'), HTTP_AUTHORIZATION=f'Token {author.token}').json()
+        self.assertFalse(data['posts'][0]['upvoted'])
+
+@override_settings(SHARDS={'ALIASES': ['default', 'shard1']})
+class ShardingTests(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        clear_caches()
+        token_revocations.clear()
+        call_command('init_shards', stdout=StringIO())
+        self.author = create_user()
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.author.token}'}
+        self.first = Subreddit.objects.create('First', self.author)
+        self.second = Subreddit.objects.create('Second', self.author)
+        Subreddit.objects.filter(pk=self.first.pk).update(shard=0)
+        Subreddit.objects.filter(pk=self.second.pk).update(shard=1)
+
+    def create_post(self, subreddit, title):
+        response = self.client.post(
+            reverse('redditapp:create_post', args=[subreddit.name]),
+            {'post': {'title': title, 'text': 'body'}},
+            content_type='application/json',
+            **self.auth
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def test_rows_live_on_their_subreddits_shard(self):
+        post_id = self.create_post(self.second, 'sharded')
+        self.assertGreater(post_id, sharding.ID_RANGE)
+        self.assertTrue(Post.objects.using('shard1').filter(pk=post_id).exists())
+        self.assertFalse(Post.objects.using('default').filter(pk=post_id).exists())
+
+        comment = self.client.post(
+            reverse('redditapp:create_comment'),
+            {'comment': {'post_id': post_id, 'text': 'first'}},
+            content_type='application/json',
+            **self.auth
+        ).json()
+        voter = User.objects.create_user('voter', 'password')
+        response = self.client.post(
+            reverse('redditapp:vote_comment'),
+            {'vote': {'comment_id': comment['id'], 'value': 1}},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {voter.token}'
+        )
+        self.assertEqual(response.json()['comment']['votes'], 2)
+        self.assertEqual(Vote.objects.using('shard1').filter(comment_id=comment['id']).count(), 2)
+        self.assertFalse(Vote.objects.using('default').filter(comment_id=comment['id']).exists())
+
+        data = self.client.get(reverse('redditapp:comments_page', args=[post_id]), **self.auth).json()
+        self.assertEqual((data['title'], data['subreddit']['name'], data['numComments']), ('sharded', 'Second', 1))
+        self.assertEqual(data['comments'][0]['votes'], 2)
+        self.assertTrue(data['comments'][0]['upvoted'])
+
+    def test_front_page_merges_shards(self):
+        ids = [self.create_post(sub, f'post {i}') for i, sub in enumerate([self.first, self.second] * 3)]
+        self.assertEqual(len({sharding.for_id(pk) for pk in ids}), 2)
+        seen = []
+        url = reverse('redditapp:posts') + '?sort=new&limit=4'
+        while url:
+            data = self.client.get(url, **self.auth).json()
+            seen += [post['id'] for post in data['posts']]
+            self.assertTrue(all(post['upvoted'] for post in data['posts']))
+            url = data['next'] and reverse('redditapp:posts') + f'?sort=new&limit=4&after={data["next"]}'
+        self.assertEqual(seen, ids[::-1])
+        data = self.client.get(reverse('redditapp:subreddit', args=['Second'])).json()
+        self.assertEqual([post['id'] for post in data['posts']], [ids[5], ids[3], ids[1]])
+
+    def test_deletion_cascades_to_every_shard(self):
+        post_id = self.create_post(self.second, 'sharded')
+        other = User.objects.create_user('other', 'password')
+        third = Subreddit.objects.create('Third', other)
+        Subreddit.objects.filter(pk=third.pk).update(shard=1)
+        other_post_id = Post.objects.create(title='other', subreddit=third, author=other).pk
+        comment = Comment.objects.create(post_id=other_post_id, author=self.author, body='reply')
+        cast_vote(self.author.pk, 1, post_id=other_post_id)
+        self.assertEqual(sharding.for_id(comment.pk), 'shard1')
+
+        self.author.delete()
+        self.assertFalse(Post.objects.using('shard1').filter(pk=post_id).exists())
+        self.assertFalse(Comment.objects.using('shard1').filter(author_id=self.author.pk).exists())
+        self.assertFalse(Vote.objects.using('shard1').filter(voter_id=self.author.pk).exists())
+        self.assertTrue(Post.objects.using('shard1').filter(pk=other_post_id).exists())
+
+        third.delete()
+        self.assertFalse(Post.objects.using('shard1').exists())
+        self.assertFalse(Vote.objects.using('shard1').exists())
+
+@override_settings(LISTING_STREAM={'CHUNK_SIZE': 2})
+class StreamingListingTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.author, post = create_post('post 0')
+        self.ids = [post.pk] + [
+            Post.objects.create(title=f'post {i}', subreddit=post.subreddit, author=self.author).pk
+            for i in range(1, 7)
+        ]
+
+    def get(self, query):
+        return self.client.get(reverse('redditapp:posts') + query, HTTP_AUTHORIZATION=f'Token {self.author.token}')
+
+    def test_stream_matches_paged_listing(self):
+        response = self.get('?sort=new&stream=1')
+        self.assertTrue(response.streaming)
+        with CaptureQueriesContext(connection) as queries:
+            data = json.loads(b''.join(response.streaming_content))
+        # Four chunks of posts and the viewer's votes on each
+        self.assertEqual(len(queries), 8)
+        self.assertEqual(data, self.get('?sort=new&limit=100').json())
+        self.assertEqual([post['id'] for post in data['posts']], self.ids[::-1])
+        self.assertTrue(all(post['upvoted'] for post in data['posts']))
+
+    def test_stream_limit_and_cursor(self):
+        paged = self.get('?sort=new&limit=3').json()
+        streamed = json.loads(b''.join(self.get('?sort=new&limit=3&stream=1').streaming_content))
+        self.assertEqual(streamed, paged)
+        rest = self.get(f'?sort=new&stream=1&after={streamed["next"]}')
+        data = json.loads(b''.join(rest.streaming_content))
+        self.assertEqual([post['id'] for post in data['posts']], self.ids[3::-1])
+        self.assertIsNone(data['next'])
+
+class FastSerializerTests(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_comments_page_matches_drf(self):
+        author, post, first = create_comment('first')
+        _, _, reply = create_comment('reply', post=post, parent_comment=first)
+        create_comment('nested reply', post=post, parent_comment=reply)
+        _, _, deleted = create_comment('deleted', post=post)
+        Comment.objects.filter(pk=deleted.pk).update(is_deleted=True)
+        post = Post.objects.select_related('subreddit__creator', 'author').get(pk=post.pk)
+
+        slow = PostSerializer(post, context={'shared': True}).data
+        fast = fast_serializers.comments_page(post)
+        self.assertEqual(self.render(fast), self.render(slow))
+        self.assertEqual(fast['comments'][1]['author'], {'username': '[deleted]'})
+
+    def test_subreddit_directory_matches_drf(self):
+        author = create_user()
+        for name in ('one', 'two', 'three'):
+            Subreddit.objects.create(name, author)
+        subreddits = list(Subreddit.objects.select_related('creator').order_by('name'))
+
+        slow = SubredditSerializer(subreddits, many=True).data
+        self.assertEqual(self.render(fast_serializers.subreddits(subreddits)), self.render(slow))
+        response = self.client.get(reverse('redditapp:subreddit_list'))
+        self.assertEqual([s['name'] for s in response.json()['subreddits']], ['one', 'three', 'two'])
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_serializers', nodes=50, repeat=1, stdout=out)
+        self.assertIn('50 comments', out.getvalue())
@@ -0,0 +1,91 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.utils import timezone
+
+# How long a token is good for; a revocation older than this has nothing
+# left to revoke
+TOKEN_LIFETIME = timedelta(days=60)
+# How far back each reload looks before the previous one started, for
+# changes saved before it that were not committed yet
+OVERLAP = timedelta(minutes=1)
+
+class TokenRevocations:
+    """
+    The token version of every user whose tokens have been revoked (their
+    password, active status or permissions changed, or they were deleted),
+    so JWTAuthentication can reject old tokens without loading the user.
+
+    Only users revoked within the last TOKEN_LIFETIME are kept, which is
+    few of them.  The set is loaded once and then topped up every
+    `TOKEN_REVOCATION_REFRESH` seconds with the users changed or deleted
+    since, so a revocation made by another process takes effect within
+    that time; revocations made by this process apply straight away.  With
+    the setting at None the set is never loaded, which only suits a single
+    process.
+    """
+    # Revokes every token of a deleted user
+    DELETED = float('inf')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._revoked_at = {}
+        self._loaded_at = None
+        self._since = None
+
+    def _refresh(self):
+        interval = settings.TOKEN_REVOCATION_REFRESH
+        if interval is None:
+            return
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < interval:
+            return
+        # Only one thread reloads; the others keep using the current set
+        if not self._lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            started = timezone.now()
+            User = apps.get_model('redditapp', 'User')
+            RevokedUser = apps.get_model('redditapp', 'RevokedUser')
+            # A version bump saves the user, so users not saved for a
+            # token lifetime have no revoked tokens left
+            users = User.objects.filter(token_version__gt=0, updated_at__gt=started - TOKEN_LIFETIME)
+            deleted = RevokedUser.objects.all()
+            if self._since is not None:
+                users = users.filter(updated_at__gte=self._since)
+                deleted = deleted.filter(deleted_at__gte=self._since)
+            for user_id, version, revoked_at in users.values_list('pk', 'token_version', 'updated_at'):
+                self.revoke(user_id, version, revoked_at)
+            for user_id, revoked_at in deleted.values_list('user_id', 'deleted_at'):
+                self.revoke(user_id, self.DELETED, revoked_at)
+            self._expire(started - TOKEN_LIFETIME)
+            self._since = started - OVERLAP
+            self._loaded_at = now
+        finally:
+            self._lock.release()
+
+    def is_revoked(self, user_id, version):
+        self._refresh()
+        return version < self._versions.get(user_id, 0)
+
+    def revoke(self, user_id, version, revoked_at=None):
+        if version > self._versions.get(user_id, 0):
+            self._versions[user_id] = version
+            self._revoked_at[user_id] = revoked_at or timezone.now()
+
+    def _expire(self, before):
+        for user_id, revoked_at in list(self._revoked_at.items()):
+            if revoked_at < before:
+                del self._versions[user_id], self._revoked_at[user_id]
+
+    def clear(self):
+        self._versions = {}
+        self._revoked_at = {}
+        self._loaded_at = None
+        self._since = None
+
+token_revocations = TokenRevocations()
@@ -15,5 +15,6 @@ urlpatterns = [
     path('subreddits/', views.SubredditList.as_view(), name='subreddit_list'),
     path('comment/vote/', views.VoteOnComment.as_view(), name='vote_comment'),
     path('comment/<int:pk>/', views.EditCommentView.as_view(), name='edit_comment'),
-    path('post/<int:pk>/', views.CommentsPage.as_view(), name='comments_page')
+    path('post/<int:pk>/', views.CommentsPage.as_view(), name='comments_page'),
+    path('listing-cache/stats/', views.listing_cache_stats, name='listing_cache_stats')
 ]
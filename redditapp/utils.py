@@ -0,0 +1,17 @@
+def pk_batches(queryset, batch_size=1000):
+    """
+    Yields `(first_pk, last_pk)` ranges covering the primary keys of
+    `queryset`, `batch_size` rows at a time.  Each range is found by seeking
+    past the previous one on the primary key index, so batches deep into a
+    large table cost the same as the first and no long running transaction
+    or table lock is needed to walk it.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(batch[:batch_size])
+        if not pks:
+            return
+        yield pks[0], pks[-1]
+        last_pk = pks[-1]
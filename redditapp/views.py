@@ -1,11 +1,24 @@
-from django.db import transaction
+import contextvars
+import hashlib
+import heapq
+import json
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import FieldError
+
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views import View
 from django.contrib.auth import authenticate
 import jwt
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework import status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.views import APIView
 from rest_framework.generics import (
     RetrieveUpdateAPIView,
@@ -14,49 +27,249 @@ from rest_framework.generics import (
     UpdateAPIView,
     RetrieveAPIView
 )
-from rest_framework.permissions import AllowAny, IsAuthenticated, DjangoObjectPermissions
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated, DjangoObjectPermissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.renderers import JSONRenderer
 
 from .models import *
 from .serializers import *
+from . import fast_serializers, sharding
+from .cache import shared_cache
+from .listing_cache import listing_cache, post_row
+from .pagination import KeysetPagination, cursor_for, encode_cursor, keyset_filter, page_params, paginate
 from .renderers import UserJSONRenderer
+from .votes import VoteMap, cast_vote
+from .vote_buffer import vote_buffer
+
+LISTING_ORDERS = {
+    'hot': ('-hot', '-id'),
+    'new': ('-created', '-id'),
+    'top': ('-votes', '-id'),
+}
+
+def listing(request, queryset, subreddit_id=None):
+    sort = request.query_params.get('sort', 'hot')
+    if sort not in LISTING_ORDERS:
+        raise ValidationError({'sort': f'sort must be one of {", ".join(LISTING_ORDERS)}'})
+    ordering = LISTING_ORDERS[sort]
+    if request.query_params.get('stream'):
+        limit, after = page_params(request, Post, ordering, default_limit=None, max_limit=None)
+        content = stream_listing(request.user, queryset, subreddit_id, ordering, limit, after)
+        return StreamingHttpResponse(in_request_context(content), content_type='application/json')
+    limit, after = page_params(request, Post, ordering)
+    if subreddit_id is None and sharding.enabled():
+        rows, next_cursor = merged_page(queryset, sort, ordering, limit, after)
+    else:
+        with sharding.using(sharding.for_subreddit(subreddit_id) if subreddit_id else None):
+            rows, next_cursor = listing_page(queryset, (subreddit_id, sort), ordering, limit, after)
+    votes = VoteMap.for_posts(request.user, [row['id'] for row in rows])
+    post_data = [listing_entry(row, votes) for row in rows]
+    return JsonResponse({'posts': post_data, 'next': next_cursor})
+
+def listing_entry(row, votes):
+    """A post's entry in a listing, with the viewer's vote and buffered votes."""
+    return dict(
+        row,
+        score=row['score'] + vote_buffer.pending(post_id=row['id']),
+        upvoted=votes.post(row['id']) == 1,
+        downvoted=votes.post(row['id']) == -1
+    )
+
+def shard_posts(alias, queryset, ordering, after, chunk_size):
+    """
+    Yields `(sort values, post)` for the posts of `queryset` on a shard
+    (None without sharding) after `after` in `ordering`.  They are read
+    `chunk_size` at a time, each chunk seeking past the last with a keyset
+    query, so only one chunk is ever held.  Server side cursors would not
+    do: MySQL's driver reads the whole result into memory regardless.
+    """
+    columns = [f.lstrip('-') for f in ordering]
+    queryset = sharding.related(queryset, 'subreddit').order_by(*ordering)
+    while True:
+        with sharding.using(alias):
+            chunk = queryset if after is None else queryset.filter(keyset_filter(ordering, after))
+            posts = list(chunk[:chunk_size])
+        for post in posts:
+            after = tuple(getattr(post, column) for column in columns)
+            yield after, post
+        if len(posts) < chunk_size:
+            return
+
+def stream_listing(user, queryset, subreddit_id, ordering, limit, after):
+    """
+    Yields a listing as JSON text piece by piece, in the shape `listing`
+    returns, a chunk of `LISTING_STREAM['CHUNK_SIZE']` posts at a time.
+    With sharding on, the front page merges the shards' streams as it goes.
+    """
+    chunk_size = settings.LISTING_STREAM['CHUNK_SIZE']
+    if subreddit_id is None:
+        aliases = sharding.aliases() if sharding.enabled() else [None]
+    else:
+        aliases = [sharding.for_subreddit(subreddit_id)]
+    streams = [shard_posts(alias, queryset, ordering, after, chunk_size) for alias in aliases]
+    posts = heapq.merge(*streams, key=lambda item: item[0], reverse=ordering[0].startswith('-'))
+    if limit is not None:
+        # One more than the limit tells whether there is a next page
+        posts = islice(posts, limit + 1)
+    yield '{"posts": ['
+    sent = 0
+    last = None
+    more = False
+    for chunk in iter(lambda: list(islice(posts, chunk_size)), []):
+        if limit is not None and sent + len(chunk) > limit:
+            chunk = chunk[:limit - sent]
+            more = True
+        if not chunk:
+            break
+        votes = VoteMap.for_posts(user, [post.pk for key, post in chunk])
+        entries = (json.dumps(listing_entry(post_row(post), votes), cls=DjangoJSONEncoder) for key, post in chunk)
+        yield (',' if sent else '') + ','.join(entries)
+        sent += len(chunk)
+        last = chunk[-1][1]
+    next_cursor = cursor_for(last, ordering) if more else None
+    yield '], "next": ' + json.dumps(next_cursor) + '}'
+
+def in_request_context(iterator):
+    """
+    Runs each step of `iterator` in a copy of the current context.  Streamed
+    content is produced after the view, and the middleware around it, have
+    returned; this keeps the replica and shard they chose.
+    """
+    context = contextvars.copy_context()
+    def steps():
+        while True:
+            try:
+                yield context.run(next, iterator)
+            except StopIteration:
+                return
+    return steps()
+
+def listing_page(queryset, listing_key, ordering, limit, after):
+    page = listing_cache.page(queryset, listing_key, ordering, limit, after)
+    if page is None:
+        posts, next_cursor = paginate(sharding.related(queryset, 'subreddit'), ordering, limit, after)
+        page = [post_row(p) for p in posts], next_cursor
+    return page
+
+def shard_keys(queryset, sort, ordering, limit, after):
+    """
+    The sort column values of the first `limit` posts after `after` on the
+    current shard, and whether there are more.
+    """
+    page = listing_cache.keys(queryset, (None, sort, sharding.current()), ordering, limit, after)
+    if page is not None:
+        return page[0], page[1] is not None
+    if after is not None:
+        queryset = queryset.filter(keyset_filter(ordering, after))
+    columns = [f.lstrip('-') for f in ordering]
+    keys = [tuple(key) for key in queryset.order_by(*ordering).values_list(*columns)[:limit + 1]]
+    return keys[:limit], len(keys) > limit
+
+def merged_page(queryset, sort, ordering, limit, after):
+    """
+    The front page with sharding on.  Each shard ranks its own posts and
+    the ranked lists are merged, which gives the same order as ranking
+    every post at once since the cursor (sort values and id) means the same
+    on every shard.
+    """
+    ranked = []
+    more = False
+    for alias in sharding.aliases():
+        with sharding.using(alias):
+            keys, shard_more = shard_keys(queryset, sort, ordering, limit, after)
+        ranked.append(keys)
+        more = more or shard_more
+    merged = list(heapq.merge(*ranked, reverse=ordering[0].startswith('-')))
+    more = more or len(merged) > limit
+    merged = merged[:limit]
+    rows = {}
+    version = listing_cache.version(None)
+    for alias, ids in sharding.by_shard([key[-1] for key in merged]):
+        with sharding.using(alias):
+            rows.update((row['id'], row) for row in listing_cache.load_rows(queryset.model, ids, version))
+    next_cursor = encode_cursor(merged[-1]) if merged and more else None
+    return [rows[key[-1]] for key in merged if key[-1] in rows], next_cursor
+
+def subreddit_id(name):
+    """The id of the subreddit called `name`, or None if there is none."""
+    return shared_cache.get_or_set(
+        'subreddit-ids',
+        name,
+        lambda: Subreddit.objects.filter(name=name).values_list('pk', flat=True).first(),
+        ttl=3600
+    )
+
+def etag(request, *versions):
+    """
+    A strong ETag for a response built from content at `versions`.  The
+    query string and the credentials are part of it too, since they change
+    the page and the viewer's votes shown on it.
+    """
+    parts = versions + (request.META.get('QUERY_STRING', ''), request.META.get('HTTP_AUTHORIZATION', ''))
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def listing_etag(request, subreddit_name=None):
+    key = 'all' if subreddit_name is None else subreddit_id(subreddit_name)
+    if key is None:
+        return None
+    return etag(request, 'listings', key, shared_cache.version('listings', key))
 
+def comments_page_etag(request, pk):
+    # The relative times on the page change as the minutes go by
+    return etag(request, 'comments-page', pk, shared_cache.version('comments-page', pk), int(time.time() // 60))
+
+def directory_etag(request):
+    return etag(request, 'subreddits', shared_cache.version('subreddits', 'directory'))
+
+@condition(etag_func=listing_etag)
+@api_view(['GET'])
+@permission_classes((AllowAny,))
 def posts(request):
-    post_data = []
-    for p in Post.objects.filter(is_deleted=False).order_by('-votes', '-created'):
-        post_data.append({
-            'id': p.id,
-            'title': p.title,
-            'slug': p.slug,
-            'subreddit': p.subreddit.name,
-            'link': p.link,
-            'numComments': len(p.comment_set.all()),
-            'score': p.votes
-        })
-    return JsonResponse({'posts': post_data})
+    return listing(request, Post.objects.filter(is_deleted=False))
 
+@condition(etag_func=listing_etag)
+@api_view(['GET'])
+@permission_classes((AllowAny,))
 def subreddit(request, subreddit_name):
-    sub = Subreddit.objects.get(name=subreddit_name)
-    post_data = []
-    for p in sub.post_set.filter(is_deleted=False).order_by('-votes', '-created'):
-        post_data.append({
-            'id': p.id,
-            'title': p.title,
-            'link': p.link,
-            'slug': p.slug,
-            'subreddit': sub.name,
-            'numComments': len(p.comment_set.all()),
-            'score': p.votes
-        })
-    return JsonResponse({'posts': post_data})
+    sub_id = subreddit_id(subreddit_name)
+    if sub_id is None:
+        raise NotFound('Subreddit not found')
+    return listing(request, Post.objects.filter(subreddit_id=sub_id, is_deleted=False), sub_id)
 
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def listing_cache_stats(request):
+    return JsonResponse(dict(listing_cache.stats(), shared=shared_cache.stats()))
+
+@method_decorator(condition(etag_func=comments_page_etag), name='dispatch')
 class CommentsPage(RetrieveAPIView):
+    """
+    The post and its comment tree are serialized once per version of the
+    post (by the precompiled serializer in fast_serializers.py), without the
+    viewer's votes or relative times, and cached; each
+    request only loads the viewer's votes and merges them in.  Comments,
+    edits and votes bump the version (see `invalidate_comments_page`).
+    """
     permission_classes = (AllowAny,)
     serializer_class = PostSerializer
     queryset = Post.objects.all()
 
+    def get_queryset(self):
+        return sharding.related(self.queryset, 'subreddit__creator', 'author')
+
+    def retrieve(self, request, *args, **kwargs):
+        post_id = kwargs['pk']
+        with sharding.using(sharding.for_id(post_id)):
+            version = shared_cache.version('comments-page', post_id)
+            page = shared_cache.get_or_set(
+                'comments-page',
+                f'{post_id}:{version}',
+                lambda: fast_serializers.comments_page(self.get_object()),
+                ttl=60
+            )
+            return Response(personalize_page(page, VoteMap.for_post(request.user, post_id)))
+
 class RegistrationAPIView(APIView):
     permission_classes = (AllowAny,)
     renderer_classes = (UserJSONRenderer,)
@@ -94,8 +307,10 @@ class UserRetrieveUpdateAPIView(RetrieveUpdateAPIView):
 
     def update(self, request, *args, **kwargs):
         serializer_data = request.data.get('user', {})
+        # request.user answers the token's claims, which this may change
+        user = User.objects.get(pk=request.user.pk)
         serializer = self.serializer_class(
-            request.user, data=serializer_data, partial=True
+            user, data=serializer_data, partial=True
         )
         serializer.is_valid(raise_exception=True)
         serializer.save()
@@ -116,6 +331,11 @@ class CreateSubredditView(CreateAPIView):
         return Response(SubredditSerializer(subreddit).data, status=status.HTTP_201_CREATED)
 
 class CreatePostView(CreateAPIView):
+    """
+    Creates a post with two statements: the post and the author's vote
+    (see `test_create_query_budget`).  The subreddit is looked up by name
+    in the cache.
+    """
     permission_classes = (IsAuthenticated,)
     renderer_classes = (JSONRenderer,)
     serializer_class = PostSerializer
@@ -123,12 +343,14 @@ class CreatePostView(CreateAPIView):
     def create(self, request, subreddit_name, *args, **kwargs):
         author = request.user
         data = request.data.get('post', {})
-        subreddit = Subreddit.objects.get(name=subreddit_name)
-        with transaction.atomic():
+        sub_id = subreddit_id(subreddit_name)
+        if sub_id is None:
+            raise NotFound('Subreddit not found')
+        with sharding.using(sharding.for_subreddit(sub_id)), sharding.atomic():
             post = Post.objects.create(
                 title=data['title'],
-                subreddit=subreddit,
-                text=Text.objects.create(text=Text.objects.create(text=data.get('text', ''))),
+                subreddit_id=sub_id,
+                body=data.get('text', ''),
                 link=data.get('link', ''),
                 author=author
             )
@@ -139,6 +361,12 @@ class CreatePostView(CreateAPIView):
         }, status=status.HTTP_201_CREATED)
 
 class CreateCommentView(CreateAPIView):
+    """
+    Creates a comment with three statements: the post's comment count
+    (which also checks the post exists), the comment and the author's
+    vote.  The response is serialized from what was just written, without
+    further queries.
+    """
     permission_classes = (IsAuthenticated,)
     renderer_classes = (JSONRenderer,)
     serializer_class = CommentSerializer
@@ -149,25 +377,60 @@ class CreateCommentView(CreateAPIView):
         post_id = data['post_id']
         parent_comment_id = data.get('parent_comment_id')
         text = data.get('text')
-        with transaction.atomic():
-            comment = Comment.objects.create(
-                post=Post.objects.get(pk=post_id),
-                author=author,
-                parent_comment=parent_comment_id and Comment.objects.get(pk=parent_comment_id),
-                text=Text.objects.create(text=text)
-            )
-        d = CommentSerializer(comment, context={'request': request}).data
+        try:
+            with sharding.using(sharding.for_id(post_id)), sharding.atomic():
+                comment = Comment.objects.create(
+                    post_id=post_id,
+                    author=author,
+                    parent_comment_id=parent_comment_id,
+                    body=text
+                )
+        except Post.DoesNotExist:
+            raise NotFound('Post not found')
+        # A new comment has no replies, no shard counts and only its author's vote
+        comment._child_comments = []
+        d = CommentSerializer(comment, context={
+            'request': request,
+            'votes': VoteMap(comment_votes={comment.pk: 1}),
+            'shard_votes': {}
+        }).data
         return Response(d, status=status.HTTP_201_CREATED)
 
 class EditCommentView(UpdateAPIView):
     permission_classes = (IsAuthenticated, DjangoObjectPermissions)
     renderer_classes = (JSONRenderer,)
     serializer_class = CommentSerializer
-    queryset = Comment.objects.all()
+    # The permission check reads the post's subreddit for non-authors
+    queryset = Comment.objects.select_related('post')
+
+    def update(self, request, *args, **kwargs):
+        with sharding.using(sharding.for_id(kwargs['pk'])):
+            return super(EditCommentView, self).update(request, *args, **kwargs)
 
+@method_decorator(condition(etag_func=directory_etag), name='dispatch')
 class SubredditList(ListAPIView):
-    queryset = Subreddit.objects.filter(is_deleted=False).order_by('name')
+    queryset = Subreddit.objects.filter(is_deleted=False).select_related('creator')
     serializer_class = SubredditSerializer
+    pagination_class = KeysetPagination
+    ordering = ('name',)
+    results_key = 'subreddits'
+
+    def list(self, request, *args, **kwargs):
+        # Saving any subreddit bumps the version, dropping every cached page
+        version = shared_cache.version('subreddits', 'directory')
+        params = request.query_params
+        key = f'{version}:{params.get("limit", "")}:{params.get("after", "")}'
+        data = shared_cache.get_or_set(
+            'subreddits',
+            key,
+            self.page_data,
+            ttl=300
+        )
+        return Response(data)
+
+    def page_data(self):
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        return self.get_paginated_response(fast_serializers.subreddits(page)).data
 
 class VoteOnComment(APIView):
     permission_classes = (IsAuthenticated,)
@@ -175,19 +438,20 @@ class VoteOnComment(APIView):
     renderer_classes = (JSONRenderer,)
 
     def post(self, request, *args, **kwargs):
-        voter = request.user
         data = request.data.get('vote', {})
-        comment = Comment.objects.get(pk=data['comment_id'])
+        comment_id = data['comment_id']
+        value = data['value']
         try:
-            vote = Vote.objects.get(voter=voter, comment=comment)
-        except Vote.DoesNotExist:
-            vote = Vote.objects.create(voter, data['value'], comment=comment)
-        else:
-            if data['value'] in [-1, 1]:
-                vote.value = data['value']
-                vote.save()
-            elif data['value'] == 0:
-                vote.delete()
+            votes = cast_vote(request.user.pk, value, comment_id=comment_id)
+        except FieldError as e:
+            raise ValidationError({'value': [str(e)]})
+        except Comment.DoesNotExist:
+            raise NotFound('Comment not found.')
         return Response({
-            'comment': CommentSerializer(Comment.objects.get(pk=data['comment_id']), context={'request': request}).data
+            'comment': {
+                'id': comment_id,
+                'votes': votes,
+                'upvoted': value == 1,
+                'downvoted': value == -1
+            }
         }, status=status.HTTP_201_CREATED)
@@ -0,0 +1,91 @@
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+class VoteBuffer:
+    """
+    Collects changes to the `votes` counters of posts and comments in memory
+    and writes them with one UPDATE per post/comment from a background
+    thread, every `FLUSH_INTERVAL_MS` or after `MAX_EVENTS` changes.  A post
+    receiving thousands of votes then takes its row lock once per flush
+    instead of once per vote.  Posts' hot scores are recomputed at the same
+    time.
+
+    The votes themselves are still written immediately; only the counters
+    lag, and `pending()` lets reads add the unflushed changes back in.
+    Enabled with `VOTE_BUFFER['ENABLED']` in the settings.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deltas = Counter()
+        # Deltas taken by a flush that is still writing them
+        self._flushing = Counter()
+        self._events = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def options(self):
+        return settings.VOTE_BUFFER
+
+    @property
+    def enabled(self):
+        return self.options['ENABLED']
+
+    def add(self, delta, post_id=None, comment_id=None):
+        key = ('comment', comment_id) if comment_id else ('post', post_id)
+        with self._lock:
+            self._deltas[key] += delta
+            self._events += 1
+            full = self._events >= self.options['MAX_EVENTS']
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vote-buffer', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def pending(self, post_id=None, comment_id=None):
+        if not self._deltas and not self._flushing:
+            return 0
+        key = ('comment', comment_id) if comment_id else ('post', post_id)
+        with self._lock:
+            return self._deltas.get(key, 0) + self._flushing.get(key, 0)
+
+    def flush(self):
+        with self._lock:
+            deltas = self._deltas
+            self._flushing.update(deltas)
+            self._deltas = Counter()
+            self._events = 0
+        for key, delta in deltas.items():
+            model_name, pk = key
+            try:
+                if delta:
+                    model = apps.get_model('redditapp', model_name)
+                    model.objects.add_votes(pk, delta)
+            except Exception:
+                logger.exception('Could not flush %s vote delta for %s %s', delta, model_name, pk)
+                with self._lock:
+                    self._deltas[key] += delta
+            with self._lock:
+                self._flushing.subtract({key: delta})
+                if not self._flushing[key]:
+                    del self._flushing[key]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.options['FLUSH_INTERVAL_MS'] / 1000)
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()
+
+vote_buffer = VoteBuffer()
+
+atexit.register(vote_buffer.flush)
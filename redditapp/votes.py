@@ -0,0 +1,126 @@
+from django.core.exceptions import FieldError
+from django.db import IntegrityError
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+
+from redditclone.metrics import registry
+
+from . import sharding
+from .models import Comment, Post, Vote, VoteCounterShard, add_to_votes, vote_target
+from .vote_buffer import vote_buffer
+
+class VoteMap:
+    """
+    The viewer's votes on a page of posts and comments, loaded with a single
+    query so serializers can look up `upvoted`/`downvoted` without touching
+    the database.
+    """
+    def __init__(self, post_votes=None, comment_votes=None):
+        self.post_votes = post_votes or {}
+        self.comment_votes = comment_votes or {}
+
+    @classmethod
+    def _load(cls, user, condition):
+        vote_map = cls()
+        if not user or not user.is_authenticated:
+            return vote_map
+        votes = Vote.objects.filter(condition, voter_id=user.pk)
+        for post_id, comment_id, value in votes.values_list('post_id', 'comment_id', 'value'):
+            if post_id is not None:
+                vote_map.post_votes[post_id] = value
+            else:
+                vote_map.comment_votes[comment_id] = value
+        return vote_map
+
+    @classmethod
+    def for_post(cls, user, post_id):
+        """The viewer's votes on a post and on every comment of that post."""
+        comment_ids = Comment.objects.filter(post_id=post_id).values('pk')
+        with sharding.using(sharding.for_id(post_id)):
+            return cls._load(user, Q(post_id=post_id) | Q(comment_id__in=comment_ids))
+
+    @classmethod
+    def for_posts(cls, user, post_ids):
+        """The viewer's votes on a listing of posts, one query per shard they are on."""
+        vote_map = cls()
+        for alias, ids in sharding.by_shard(post_ids):
+            with sharding.using(alias):
+                vote_map.post_votes.update(cls._load(user, Q(post_id__in=ids)).post_votes)
+        return vote_map
+
+    def post(self, post_id):
+        return self.post_votes.get(post_id, 0)
+
+    def comment(self, comment_id):
+        return self.comment_votes.get(comment_id, 0)
+
+def cast_vote(voter_id, value, post_id=None, comment_id=None):
+    """
+    Records a vote of `value` (1 or -1, or 0 to remove the vote) by
+    `voter_id` on a post or comment and returns the target's new score.
+
+    The unique constraints on `Vote` make each case a single write: a new
+    vote is an INSERT, a changed vote is an UPDATE that only matches when the
+    stored value differs and a removed vote is a DELETE.  The number of rows
+    each statement touched gives the change to the target's counter, so the
+    existing vote never has to be read first.
+
+    Raises Post.DoesNotExist or Comment.DoesNotExist, before anything is
+    written, if the target does not exist.
+    """
+    if value not in [-1, 0, 1]:
+        raise FieldError('value must be in [-1, 0, 1]')
+    with sharding.using(sharding.for_id(comment_id or post_id)):
+        return _cast_vote(voter_id, value, post_id, comment_id)
+
+def _cast_vote(voter_id, value, post_id, comment_id):
+    target = {'comment_id': comment_id} if comment_id else {'post_id': post_id}
+    model = Comment if comment_id else Post
+    votes = Vote.objects.filter(voter_id=voter_id, **target)
+    with sharding.atomic():
+        # Looked up before the vote is written: the IntegrityError below is
+        # taken for a duplicate vote, and SQLite only checks foreign keys at
+        # commit.  vote_target finds no subreddit for a missing target.
+        located = vote_target(**target)
+        if located[2] is None:
+            raise model.DoesNotExist(f'{model.__name__} matching query does not exist.')
+        if value == 0:
+            if votes.filter(value=1).delete()[0]:
+                delta = -1
+            else:
+                delta = votes.delete()[0]
+        else:
+            try:
+                with sharding.atomic():
+                    Vote.objects.bulk_create([Vote(
+                        voter_id=voter_id,
+                        value=value,
+                        is_post=comment_id is None,
+                        is_comment=comment_id is not None,
+                        **target
+                    )])
+                delta = value
+            except IntegrityError:
+                delta = 2 * value * votes.exclude(value=value).update(value=value)
+        add_to_votes(delta, voter_id=voter_id, located=located, **target)
+    registry.inc('redditapp_votes_total')
+    votes, shard_votes = model.objects.filter(pk=comment_id or post_id).annotate(
+        shard_votes=Coalesce(Sum('votecountershard__votes'), 0)
+    ).values_list('votes', 'shard_votes').get()
+    return votes + shard_votes + vote_buffer.pending(**target)
+
+def fold_vote_shards(post_id=None, comment_id=None):
+    """
+    Moves the counts held in a post or comment's VoteCounterShard rows into
+    its `votes` column, so listings that only read the column catch up.
+    """
+    target = {'comment_id': comment_id} if comment_id else {'post_id': post_id}
+    model = Comment if comment_id else Post
+    with sharding.using(sharding.for_id(comment_id or post_id)), sharding.atomic():
+        shards = list(
+            VoteCounterShard.objects.select_for_update().filter(**target).exclude(votes=0)
+        )
+        total = sum(shard.votes for shard in shards)
+        VoteCounterShard.objects.filter(pk__in=[shard.pk for shard in shards]).update(votes=0)
+        model.objects.add_votes(comment_id or post_id, total)
+    return total
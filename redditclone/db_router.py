@@ -0,0 +1,54 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+# The replica the reads of the current request go to, or None for the primary
+_replica = ContextVar('replica', default=None)
+
+class ReplicaRouter:
+    """
+    Sends reads to the replica chosen for the current request (see
+    `replica_middleware`) and everything else to the primary, 'default'.
+    Every alias holds the same rows, so relations between them are allowed.
+    """
+    def db_for_read(self, model, **hints):
+        return _replica.get() or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+@contextmanager
+def replica():
+    """Reads in the block go to one of `REPLICAS['ALIASES']`, if there are any."""
+    aliases = settings.REPLICAS['ALIASES']
+    token = _replica.set(random.choice(aliases) if aliases else None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+@contextmanager
+def primary():
+    """
+    Reads in the block go to the primary.  For values cached across
+    requests: filled from a replica behind the write that invalidated them,
+    they would hide the write, even from its author, until they expire.
+    """
+    token = _replica.set(None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+def pin(user_id):
+    """Sends the user's reads to the primary for `REPLICAS['PIN_SECONDS']`."""
+    caches['default'].set(f'primary-pin:{user_id}', 1, settings.REPLICAS['PIN_SECONDS'])
+
+def is_pinned(user_id):
+    return caches['default'].get(f'primary-pin:{user_id}') is not None
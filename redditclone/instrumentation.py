@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_stats = ContextVar('request_stats', default=None)
+
+class RequestStats:
+    """What one request spent, filled in while instrumentation_middleware runs."""
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # A database execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'serializer_ms': round(self.serializer_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+def start():
+    stats = RequestStats()
+    return stats, _stats.set(stats)
+
+def stop(token):
+    _stats.reset(token)
+
+def current():
+    """The stats of the request being instrumented, or None."""
+    return _stats.get()
+
+def record_cache(hit):
+    stats = _stats.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+@contextmanager
+def serializing():
+    """Times serialization; nested serializers are counted once."""
+    stats = _stats.get()
+    if stats is None or stats._depth:
+        yield
+        return
+    stats._depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats._depth -= 1
+        stats.serializer_time += time.perf_counter() - start
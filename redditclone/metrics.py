@@ -0,0 +1,219 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from math import inf
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+
+HISTOGRAM_BUCKETS = {
+    'http_request_duration_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, inf),
+    'http_request_queries': (0, 1, 2, 5, 10, 20, 50, 100, inf),
+}
+
+HELP = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by URL name.'),
+    'http_request_queries': ('histogram', 'Queries per sampled request by URL name.'),
+    'redditapp_votes_total': ('counter', 'Votes cast.'),
+    'redditapp_comments_total': ('counter', 'Comments created.'),
+    'redditapp_posts_total': ('counter', 'Posts created.'),
+    'db_connections_opened_total': ('counter', 'Database connections opened.'),
+    'cache_hits_total': ('counter', 'Cache hits, including stale values served.'),
+    'cache_misses_total': ('counter', 'Cache misses.'),
+}
+
+class ThreadMetrics:
+    """Counters and histograms written by a single thread."""
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+class Registry:
+    """
+    Process-wide metrics.  Each thread writes to its own counters, so
+    recording takes no lock; a scrape adds up every thread's counters.
+
+    With `METRICS['DIRECTORY']` set, each process also writes its totals to
+    a file there every `METRICS['FLUSH_INTERVAL']` seconds and the scrape
+    endpoint adds up the files of all processes, standing in for a shared
+    metrics store.  Files of processes that have exited are kept, so their
+    counts do not go backwards.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._threads = []
+        # What threads that have since exited recorded
+        self._retired = ThreadMetrics()
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def _mine(self):
+        metrics = getattr(self._local, 'metrics', None)
+        if metrics is None:
+            metrics = self._local.metrics = ThreadMetrics()
+            with self._lock:
+                self._threads.append((threading.current_thread(), metrics))
+                self._start_flusher()
+        return metrics
+
+    def inc(self, name, amount=1, **labels):
+        self._mine().counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        histograms = self._mine().histograms
+        key = (name, tuple(sorted(labels.items())))
+        counts = histograms.get(key)
+        if counts is None:
+            # One slot per bucket, then the sum
+            counts = histograms[key] = [0] * (len(HISTOGRAM_BUCKETS[name]) + 1)
+        for i, bound in enumerate(HISTOGRAM_BUCKETS[name]):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += value
+
+    def collect(self):
+        """This process's counters and histograms, keyed by `name|labels`."""
+        counters = defaultdict(float)
+        histograms = {}
+        with self._lock:
+            for thread, metrics in [t for t in self._threads if not t[0].is_alive()]:
+                merge(self._retired, metrics.counters.items(), metrics.histograms.items())
+                self._threads.remove((thread, metrics))
+            threads = [metrics for thread, metrics in self._threads] + [self._retired]
+        for metrics in threads:
+            for key, value in snapshot(metrics.counters):
+                counters[encode_key(key)] += value
+            for key, counts in snapshot(metrics.histograms):
+                merged = histograms.setdefault(encode_key(key), [0] * len(counts))
+                for i, count in enumerate(list(counts)):
+                    merged[i] += count
+        for key, value in cache_counters():
+            counters[encode_key(key)] += value
+        return {'counters': counters, 'histograms': histograms}
+
+    def _start_flusher(self):
+        if self._flusher is None and settings.METRICS['DIRECTORY']:
+            self._flusher = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.METRICS['FLUSH_INTERVAL'])
+            self.flush()
+
+    def flush(self):
+        directory = settings.METRICS['DIRECTORY']
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.collect(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect_all(self):
+        """The metrics of every process writing to the directory, or just this one."""
+        directory = settings.METRICS['DIRECTORY']
+        if not directory:
+            return self.collect()
+        self.flush()
+        counters = defaultdict(float)
+        histograms = {}
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, value in data['counters'].items():
+                counters[key] += value
+            for key, counts in data['histograms'].items():
+                merged = histograms.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    merged[i] += count
+        return {'counters': counters, 'histograms': histograms}
+
+registry = Registry()
+
+def snapshot(mapping):
+    # The owning thread may add a key while this one reads
+    while True:
+        try:
+            return list(mapping.items())
+        except RuntimeError:
+            pass
+
+def merge(into, counters, histograms):
+    for key, value in counters:
+        into.counters[key] += value
+    for key, counts in histograms:
+        merged = into.histograms.setdefault(key, [0] * len(counts))
+        for i, count in enumerate(counts):
+            merged[i] += count
+
+def encode_key(key):
+    name, labels = key
+    return name + '|' + json.dumps(labels)
+
+def decode_key(key):
+    name, labels = key.split('|', 1)
+    return name, [tuple(label) for label in json.loads(labels)]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def format_bound(bound):
+    return '+Inf' if bound == inf else repr(float(bound))
+
+def cache_counters():
+    from redditapp.cache import shared_cache
+    from redditapp.listing_cache import listing_cache
+    for name, stats in listing_cache.stats().items():
+        yield ('cache_hits_total', (('cache', f'listing_{name}'),)), stats['hits']
+        yield ('cache_misses_total', (('cache', f'listing_{name}'),)), stats['misses']
+    for namespace, stats in shared_cache.stats().items():
+        labels = (('cache', 'shared'), ('namespace', namespace))
+        yield ('cache_hits_total', labels), stats['hits'] + stats['stale']
+        yield ('cache_misses_total', labels), stats['misses']
+
+def render(data):
+    """Formats collected metrics in the Prometheus text exposition format."""
+    families = defaultdict(list)
+    for key, value in data['counters'].items():
+        name, labels = decode_key(key)
+        families[name].append(f'{name}{format_labels(labels)} {value}')
+    for key, counts in data['histograms'].items():
+        name, labels = decode_key(key)
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS[name], counts):
+            cumulative += count
+            bucket_labels = format_labels(labels + [('le', format_bound(bound))])
+            families[name].append(f'{name}_bucket{bucket_labels} {cumulative}')
+        families[name].append(f'{name}_sum{format_labels(labels)} {counts[-1]}')
+        families[name].append(f'{name}_count{format_labels(labels)} {cumulative}')
+    lines = []
+    for name in sorted(families):
+        kind, help_text = HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(sorted(families[name]))
+    return '\n'.join(lines) + '\n'
+
+def metrics_view(request):
+    """Serves the metrics to scrapers connecting from `METRICS['ALLOWED_IPS']`."""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS['ALLOWED_IPS']:
+        return HttpResponseForbidden()
+    return HttpResponse(render(registry.collect_all()), content_type='text/plain; version=0.0.4')
+
+def count_connection(sender, connection, **kwargs):
+    registry.inc('db_connections_opened_total', alias=connection.alias)
+
+connection_created.connect(count_connection)
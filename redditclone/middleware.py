@@ -1,3 +1,18 @@
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from . import db_router, instrumentation
+from .metrics import registry
+from .profiling import run_profiled, slow_queries
+
+logger = logging.getLogger('redditclone.requests')
+
 def dev_cors_middleware(get_response):
     """
     Adds CORS headers for local testing only to allow the frontend, which is served on
@@ -8,7 +23,119 @@ def dev_cors_middleware(get_response):
 
         response['Access-Control-Allow-Origin'] = 'http://localhost:3000'
         response['Access-Control-Allow-Methods'] = 'GET, POST, PUT, PATCH, OPTIONS, DELETE, HEAD'
-        response['Access-Control-Allow-Headers'] = 'Content-Type, X-CSRFToken, Authorization'
+        response['Access-Control-Allow-Headers'] = 'Content-Type, X-CSRFToken, Authorization, If-None-Match, X-Profile'
         response['Access-Control-Allow-Credentials'] = 'true'
+        response['Access-Control-Expose-Headers'] = 'ETag, X-Profile-Id'
+        return response
+    return middleware
+
+def instrumentation_middleware(get_response):
+    """
+    Counts the queries, database time, serializer time and cache hits of a
+    sample of requests (`INSTRUMENTATION['SAMPLE_RATE']`), returning them in
+    a Server-Timing header and logging them as one JSON line.  Requests
+    running more than `INSTRUMENTATION['QUERY_BUDGET']` queries are logged
+    as warnings.
+
+    The latency of every request, and the query count of sampled ones, also
+    go to the metrics registry (see redditclone/metrics.py).
+    """
+    def middleware(request):
+        options = settings.INSTRUMENTATION
+        started = time.perf_counter()
+        if random.random() >= options['SAMPLE_RATE']:
+            response = get_response(request)
+            observe(request, time.perf_counter() - started)
+            return response
+
+        stats, token = instrumentation.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = get_response(request)
+        finally:
+            instrumentation.stop(token)
+        total = time.perf_counter() - started
+        observe(request, total, stats.queries)
+
+        line = stats.as_dict()
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={line["db_ms"]};desc="{stats.queries} queries"',
+            f'ser;dur={line["serializer_ms"]}',
+            f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+            f'total;dur={round(total * 1000, 2)}',
+        ])
+        match = request.resolver_match
+        line.update(
+            method=request.method,
+            path=request.path,
+            view=match.view_name if match else None,
+            status=response.status_code,
+            total_ms=round(total * 1000, 2)
+        )
+        budget = options['QUERY_BUDGET']
+        if budget is not None and stats.queries > budget:
+            logger.warning(json.dumps(dict(line, over_query_budget=budget)))
+        else:
+            logger.info(json.dumps(line))
         return response
     return middleware
+
+def observe(request, duration, queries=None):
+    match = request.resolver_match
+    view = match.view_name if match else 'unmatched'
+    registry.observe('http_request_duration_seconds', duration, view=view)
+    if queries is not None:
+        registry.observe('http_request_queries', queries, view=view)
+
+def profiling_middleware(get_response):
+    """
+    Runs a request under cProfile when a staff user sends an `X-Profile`
+    header, and a sample of all requests (`PROFILING['SAMPLE_RATE']`).
+    Profiles are saved for download from /profiles/<id>/.
+
+    Statements slower than `PROFILING['SLOW_QUERY_MS']` are recorded with
+    the line of app code that ran them, reported at /profiles/slow-queries/.
+    """
+    def middleware(request):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(slow_queries))
+            if profile_requested(request):
+                return run_profiled(request, get_response)
+            return get_response(request)
+    return middleware
+
+def replica_middleware(get_response):
+    """
+    Reads of GET, HEAD and OPTIONS requests go to a replica (see
+    redditclone/db_router.py), unless the user made a successful write
+    request in the last `REPLICAS['PIN_SECONDS']`, so they always see their
+    own votes, comments and posts.
+    """
+    def middleware(request):
+        from redditapp.backends import token_claims
+        if not settings.REPLICAS['ALIASES']:
+            return get_response(request)
+        claims = token_claims(request)
+        user_id = claims['id'] if claims else None
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response = get_response(request)
+            if user_id is not None and response.status_code < 400:
+                db_router.pin(user_id)
+            return response
+        if user_id is not None and db_router.is_pinned(user_id):
+            return get_response(request)
+        with db_router.replica():
+            return get_response(request)
+    return middleware
+
+def profile_requested(request):
+    from redditapp.backends import token_claims
+    if random.random() < settings.PROFILING['SAMPLE_RATE']:
+        return True
+    if 'HTTP_X_PROFILE' not in request.META:
+        return False
+    claims = token_claims(request)
+    return bool(claims and claims['is_staff'])
@@ -0,0 +1,125 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+APP_DIR = os.path.join(settings.BASE_DIR, 'redditapp') + os.sep
+
+def call_site():
+    """
+    The innermost frame of the app's code on the stack, as
+    `path:line in function`.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR):
+            code = frame.f_code
+            name = getattr(code, 'co_qualname', code.co_name)
+            return f'{os.path.relpath(filename, settings.BASE_DIR)}:{frame.f_lineno} in {name}'
+        frame = frame.f_back
+    return 'unknown'
+
+class SlowQueries:
+    """
+    Statements slower than `PROFILING['SLOW_QUERY_MS']`, grouped by the line
+    of project code that ran them.  Used as a database execute_wrapper; only
+    slow statements pay for walking the stack.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            threshold = settings.PROFILING['SLOW_QUERY_MS']
+            if threshold is not None and elapsed >= threshold:
+                self.record(call_site(), sql, elapsed)
+
+    def record(self, site, sql, elapsed):
+        with self._lock:
+            entry = self.sites.get(site)
+            if entry is None:
+                entry = self.sites[site] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql': sql}
+            entry['count'] += 1
+            entry['total_ms'] += elapsed
+            if elapsed >= entry['max_ms']:
+                entry['max_ms'] = elapsed
+                entry['sql'] = sql
+
+    def report(self):
+        with self._lock:
+            sites = [dict(entry, site=site) for site, entry in self.sites.items()]
+        return sorted(sites, key=lambda entry: -entry['total_ms'])
+
+    def clear(self):
+        with self._lock:
+            self.sites = {}
+
+slow_queries = SlowQueries()
+
+def profile_directory():
+    return settings.PROFILING['DIRECTORY']
+
+def run_profiled(request, get_response):
+    """
+    Runs the request under cProfile and saves the stats, returning the
+    response with the profile's id in an `X-Profile-Id` header.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        response = get_response(request)
+    finally:
+        profiler.disable()
+    match = request.resolver_match
+    view = match.url_name if match and match.url_name else 'unmatched'
+    profile_id = f'{int(time.time())}-{view}-{uuid.uuid4().hex[:8]}'
+    directory = profile_directory()
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, f'{profile_id}.prof'))
+    prune(directory)
+    response['X-Profile-Id'] = profile_id
+    return response
+
+def prune(directory):
+    profiles = sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+    for name in profiles[:-settings.PROFILING['MAX_PROFILES']]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def profile_download(request, profile_id):
+    """
+    A saved profile, as a file for `pstats`, or with `?summary=1` as the
+    50 most expensive functions by cumulative time.
+    """
+    path = os.path.join(profile_directory(), f'{os.path.basename(profile_id)}.prof')
+    if not os.path.exists(path):
+        raise Http404('No such profile')
+    if request.query_params.get('summary'):
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(50)
+        return HttpResponse(out.getvalue(), content_type='text/plain')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
+
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def slow_query_report(request):
+    return JsonResponse({'slow_queries': slow_queries.report()})
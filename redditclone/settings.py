@@ -43,6 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'redditclone.middleware.instrumentation_middleware',
+    'redditclone.middleware.profiling_middleware',
+    'redditclone.middleware.replica_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,6 +89,30 @@ DATABASES = {
     }
 }
 
+# Read replicas (see redditclone/db_router.py).  ALIASES are entries of
+# DATABASES holding copies of 'default'; the reads of GET requests go to one
+# of them unless the user wrote something in the last PIN_SECONDS, which
+# should be longer than the replicas usually lag.
+REPLICAS = {
+    'ALIASES': [],
+    'PIN_SECONDS': 5,
+}
+
+# Databases posts, comments and votes are partitioned over by subreddit
+# (see redditapp/sharding.py).  The first should be 'default', which holds
+# users and subreddits; new shards are only ever appended, since a post's id
+# says which index its shard is at.  Run `migrate --database` and then
+# `init_shards` for each new one.  Shards are read directly, not through
+# the REPLICAS.
+SHARDS = {
+    'ALIASES': ['default'],
+}
+
+DATABASE_ROUTERS = [
+    'redditapp.sharding.ShardRouter',
+    'redditclone.db_router.ReplicaRouter',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -135,7 +162,93 @@ REST_FRAMEWORK = {
     )
 }
 
+# Buffer changes to post/comment vote counters in memory and write them in
+# batches from a background thread (see redditapp/vote_buffer.py)
+VOTE_BUFFER = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL_MS': 200,
+    'MAX_EVENTS': 500,
+}
+
+# How often votes held in vote counter shards are folded into the votes
+# column listings read (see redditapp/shard_folder.py)
+VOTE_SHARDS = {
+    'FOLD_INTERVAL_MS': 1000,
+}
+
+# In-process cache of ranked post listings (see redditapp/listing_cache.py).
+# DEPTH is how many posts of each listing are ranked at once, TTL bounds how
+# long changes made by other processes take to show up.
+LISTING_CACHE = {
+    'MAX_LISTS': 256,
+    'MAX_ROWS': 10000,
+    'DEPTH': 1000,
+    'TTL': 30,
+}
+
+# Listings requested with ?stream=1 are read and sent this many posts at a
+# time, and may be any length (see stream_listing in redditapp/views.py)
+LISTING_STREAM = {
+    'CHUNK_SIZE': 500,
+}
+
+# The shared (L2) tier of redditapp/cache.py's TwoTierCache.  Point this at
+# memcached or redis in production so every worker shares it; locmem only
+# shares within a process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# The in-process (L1) tier.  L1_TTL bounds how long a value deleted by
+# another process can still be served, LOCK_TIMEOUT how long one recompute
+# may hold off the others.
+TWO_TIER_CACHE = {
+    'L1_SIZE': 10000,
+    'L1_TTL': 5,
+    'LOCK_TIMEOUT': 10,
+}
+
+# Per-request query counts and timings (see redditclone/middleware.py).
+# SAMPLE_RATE is the fraction of requests measured; requests running more
+# than QUERY_BUDGET queries are logged as warnings (None to never warn).
+INSTRUMENTATION = {
+    'SAMPLE_RATE': 0.1,
+    'QUERY_BUDGET': 25,
+}
+
+# Prometheus metrics served at /metrics/ (see redditclone/metrics.py).  With
+# DIRECTORY set, every worker process writes its totals there every
+# FLUSH_INTERVAL seconds and a scrape of any worker adds them all up.
+METRICS = {
+    'DIRECTORY': None,
+    'FLUSH_INTERVAL': 10,
+    'ALLOWED_IPS': ['127.0.0.1'],
+}
+
+# Request profiles and slow statements (see redditclone/profiling.py).
+# Staff can profile any request with an X-Profile header; SAMPLE_RATE
+# profiles a fraction of all requests.  Only the newest MAX_PROFILES are
+# kept.  SLOW_QUERY_MS None turns slow statement capture off.
+PROFILING = {
+    'SAMPLE_RATE': 0,
+    'SLOW_QUERY_MS': 100,
+    'DIRECTORY': os.path.join(BASE_DIR, 'profiles'),
+    'MAX_PROFILES': 100,
+}
+
+# Seconds between reloads of the revoked token versions (see
+# redditapp/token_revocations.py); a revocation made by another process can
+# take this long to apply
+TOKEN_REVOCATION_REFRESH = 30
+
 AUTHENTICATION_BACKENDS = (
+    # Change/delete rights on posts and comments, without permission rows
+    'redditapp.backends.AuthorPermissionBackend',
     'django.contrib.auth.backends.ModelBackend', # default
-    'guardian.backends.ObjectPermissionBackend',
 )
+
+# guardian stays installed only for its tables, which the
+# purge_object_permissions command empties; its backend is no longer used
+SILENCED_SYSTEM_CHECKS = ['guardian.W001']
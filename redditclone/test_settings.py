@@ -0,0 +1,27 @@
+"""
+Settings for running the test suite against SQLite, e.g. in CI:
+
+    pytest --ds=redditclone.test_settings
+"""
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    # Stands in for a read replica in ReplicaTests, which turn it on
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db-replica.sqlite3'),
+    },
+    # A second shard for ShardingTests
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db-shard1.sqlite3'),
+    },
+}
+
+# The tests run in one process, which records every revocation itself, and
+# reloading would add queries to the ones the tests count
+TOKEN_REVOCATION_REFRESH = None
@@ -16,8 +16,14 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from .metrics import metrics_view
+from .profiling import profile_download, slow_query_report
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('redditapp.urls', namespace='redditapp')),
-    path('api-auth/', include('rest_framework.urls'))
+    path('api-auth/', include('rest_framework.urls')),
+    path('metrics/', metrics_view, name='metrics'),
+    path('profiles/slow-queries/', slow_query_report, name='slow_queries'),
+    path('profiles/<str:profile_id>/', profile_download, name='profile')
 ]